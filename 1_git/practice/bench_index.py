@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+#
+# Benchmark for the index: builds a synthetic index of N entries (100k
+# by default) in a throwaway repository, then times write_index and
+# read_index, and checks that what we read back is what we wrote.  If
+# git is installed, it also checks that git accepts the file.
+#
+# Usage: ./bench_index.py [N] [ROUNDS] [VERSION]
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from libgitrepo import GitIndex, GitRepository
+
+def bench_index_build(count):
+    """Build a GitIndex of count entries, spread over directories like
+    a real tree would be, and sorted like git wants them."""
+    index = GitIndex()
+    for i in range(count):
+        name = "dir{0:04d}/sub{1:02d}/file-{2:07d}.txt".format(i // 1000, (i // 50) % 20, i)
+        index.append_fields(1700000000 + i, i * 7, 1700000000 + i, i * 11, 2049, 1000000 + i,
+                            0o100644 if i % 97 else 0o120000, 1000, 1000, i % 65536,
+                            (i * 2654435761 % 2**160).to_bytes(20, "big"), 0, name)
+    return index
+
+def bench_time(label, fn, rounds):
+    best = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        ret = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print("{0:<14} {1:8.3f}s (best of {2})".format(label, best, rounds))
+    return ret
+
+def main(argv):
+    count = int(argv[1]) if len(argv) > 1 else 100000
+    rounds = int(argv[2]) if len(argv) > 2 else 3
+    version = argv[3] if len(argv) > 3 else "2"
+
+    path = tempfile.mkdtemp(prefix="wyag-bench-")
+    try:
+        repo = GitRepository(path, True)
+        repo.init_repo(path)
+        repo.conf["index"] = {"version": version}
+        print("{0} entries, version {1}".format(count, version))
+        index = bench_time("build", lambda: bench_index_build(count), 1)
+        bench_time("write_index", lambda: repo.write_index(index), rounds)
+        print("{0:<14} {1:8d} bytes".format("size", os.path.getsize(repo.create_filerepo("index"))))
+        read = bench_time("read_index", repo.read_index, rounds)
+
+        for col in ("ctime_s", "ctime_ns", "mtime_s", "mtime_ns", "dev", "ino",
+                    "mode", "uid", "gid", "fsize", "flags", "shas", "names"):
+            if getattr(read, col) != getattr(index, col):
+                raise Exception("Index round-trip mismatch in {0}".format(col))
+
+        if shutil.which("git"):
+            # ls-files would fail on a bad checksum or a broken entry.
+            out = subprocess.run(["git", "ls-files", "-s"], cwd=path, check=True,
+                                 capture_output=True).stdout
+            if out.count(b"\n") != count:
+                raise Exception("git read {0} entries".format(out.count(b"\n")))
+            print("git accepts the index")
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == "__main__":
+    main(sys.argv)
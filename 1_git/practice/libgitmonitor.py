@@ -0,0 +1,222 @@
+import ctypes
+import os
+import secrets
+import selectors
+import socket
+import struct
+
+
+# inotify(7) event masks.
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+
+# What we watch on every directory of the worktree.
+MONITOR_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+                | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+# struct inotify_event: wd, mask, cookie, len, then len bytes of name.
+INOTIFY_EVENT = struct.Struct("iIII")
+
+MONITOR_SOCKET = "wyag-monitor.sock"
+
+class GitMonitor(object):
+    """A daemon watching a worktree with inotify, which tells clients
+    which paths changed since they last asked.
+
+    Each change is numbered.  A client gets a token, "INSTANCE:SEQ",
+    with its answer, and gives it back next time: the answer is then
+    every path changed after SEQ.  INSTANCE is random, and changes if
+    we may have missed events (inotify's queue overflowed): a token
+    from another instance, or from a daemon that died, is stale, and
+    the client must check everything.
+
+    Paths are relative to the worktree, and may be directories (created,
+    deleted or moved): everything below them must be considered
+    changed.  .git isn't watched."""
+
+    def __init__(self, worktree, gitdir):
+        self.worktree = worktree
+        self.gitdir = gitdir
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # Watch descriptor -> path of the directory, relative to the
+        # worktree ("" for the worktree itself).
+        self.watches = dict()
+        self.instance = secrets.token_hex(8)
+        self.seq = 0
+        # Path -> number of its last change.
+        self.changes = dict()
+        self.running = True
+
+    def token(self):
+        return "{0}:{1}".format(self.instance, self.seq)
+
+    def record(self, path):
+        self.seq += 1
+        self.changes[path] = self.seq
+
+    def reset(self):
+        """Forget everything: we don't know what we missed."""
+        self.instance = secrets.token_hex(8)
+        self.seq = 0
+        self.changes = dict()
+
+    def watch(self, path):
+        """Watch directory path and everything below.  Return the list of
+        what's below, which may have been created before we watched."""
+        ret = list()
+        for (root, dirs, files) in os.walk(os.path.join(self.worktree, path)):
+            dirs[:] = [d for d in dirs if os.path.join(root, d) != self.gitdir]
+            rel = os.path.relpath(root, self.worktree)
+            rel = "" if rel == "." else rel
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), MONITOR_MASK)
+            if wd < 0:
+                # Most likely out of watches (fs.inotify.max_user_watches):
+                # we can't promise anything.
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed on {0}".format(root))
+            self.watches[wd] = rel
+            ret.extend([os.path.join(rel, name) for name in dirs + files])
+        return ret
+
+    def read_events(self):
+        """Read and record every queued event."""
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, length = INOTIFY_EVENT.unpack_from(buf, pos)
+                name = os.fsdecode(buf[pos+16:pos+16+length].rstrip(b"\x00"))
+                pos += 16 + length
+                self.event(wd, mask, name)
+
+    def event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.reset()
+            return
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+        base = self.watches.get(wd)
+        if base is None:
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            if base == "":
+                # The worktree itself is gone.
+                self.running = False
+            self.record(base)
+            return
+        path = os.path.join(base, name)
+        if os.path.join(self.worktree, path) == self.gitdir:
+            return
+        self.record(path)
+        if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+            try:
+                for sub in self.watch(path):
+                    self.record(sub)
+            except FileNotFoundError:
+                pass
+
+    def answer(self, conn):
+        """Answer one client.  Requests are a single line: "query TOKEN",
+        or "quit"."""
+        conn.settimeout(5)
+        with conn:
+            request = conn.makefile("rb").readline().decode("utf8").strip()
+            if request == "quit":
+                self.running = False
+                conn.sendall(b"ok\n")
+                return
+            if not request.startswith("query"):
+                conn.sendall(b"error\n")
+                return
+            # Events are queued by the kernel as the changes happen: once
+            # we've read them all, we know about every change made before
+            # the client asked.
+            self.read_events()
+            token = request[6:]
+            instance, _, seq = token.partition(":")
+            if instance != self.instance or not seq.isdigit():
+                conn.sendall("stale {0}\n".format(self.token()).encode("utf8"))
+                return
+            seq = int(seq)
+            changed = [path for (path, s) in self.changes.items() if s > seq]
+            conn.sendall("ok {0}\n".format(self.token()).encode("utf8")
+                         + b"".join([os.fsencode(path) + b"\x00" for path in changed]))
+
+    def run(self, sock_path):
+        self.watch("")
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(sock_path):
+            os.unlink(sock_path)
+        server.bind(sock_path)
+        server.listen()
+        selector = selectors.DefaultSelector()
+        selector.register(self.fd, selectors.EVENT_READ, "inotify")
+        selector.register(server, selectors.EVENT_READ, "socket")
+        try:
+            while self.running:
+                for (key, _) in selector.select():
+                    if key.data == "inotify":
+                        self.read_events()
+                    else:
+                        conn, _ = server.accept()
+                        try:
+                            self.answer(conn)
+                        except OSError:
+                            pass
+        finally:
+            server.close()
+            if os.path.exists(sock_path):
+                os.unlink(sock_path)
+            os.close(self.fd)
+
+def monitor_request(sock_path, request):
+    """Send request to the monitor listening on sock_path, return its
+    raw answer, or None if there's no monitor."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(5)
+            conn.connect(sock_path)
+            conn.sendall(request.encode("utf8") + b"\n")
+            conn.shutdown(socket.SHUT_WR)
+            chunks = list()
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+            return b"".join(chunks)
+    except OSError:
+        return None
+
+def monitor_query(sock_path, token):
+    """Ask the monitor what changed since token.  Return (new token,
+    list of changed paths), or (new token, None) if token is stale, or
+    None if there's no monitor: in both cases, the caller has to check
+    everything."""
+    answer = monitor_request(sock_path, "query {0}".format(token or ""))
+    if not answer:
+        return None
+    header, _, paths = answer.partition(b"\n")
+    status, _, new_token = header.decode("utf8").partition(" ")
+    if status == "stale":
+        return (new_token, None)
+    if status != "ok":
+        return None
+    return (new_token, [os.fsdecode(path) for path in paths.split(b"\x00")[:-1]])
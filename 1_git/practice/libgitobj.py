@@ -1,4 +1,7 @@
 import collections
+import concurrent.futures
+import sys
+import threading
 
 
 class GitObject(object):
@@ -117,74 +120,206 @@ class GitCommit(GitObject):
         return ret
         
 class GitTreeLeaf (object):
-    def __init__(self, mode, path, sha):
+    __slots__ = ("mode", "path", "binsha")
+
+    def __init__(self, mode, path, sha=None, binsha=None):
         self.mode = mode
         self.path = path
-        self.sha = sha
-              
+        # We keep the SHA as the 20 raw bytes stored in the tree, and
+        # only convert it to hex when someone asks for it.
+        self.binsha = binsha if binsha is not None else bytes.fromhex(sha)
+
+    @property
+    def sha(self):
+        return self.binsha.hex()
+
+    @sha.setter
+    def sha(self, value):
+        self.binsha = bytes.fromhex(value)
+
 class GitTree(GitObject):
     fmt=b'tree'
 
     def deserialize(self, data):
-        self.items = self.tree_parse(data)
+        # Parsing is deferred until someone looks at the items: callers
+        # that only need a few entries can use tree_iter() instead, and
+        # never pay for the rest.
+        self.raw = data
+        self._items = None
 
     def serialize(self):
         return self.tree_serialize()
 
     def init(self):
-        self.items = list()
-    
+        self.raw = None
+        self._items = list()
+
+    @property
+    def items(self):
+        if self._items is None:
+            self._items = self.tree_parse(self.raw)
+        return self._items
+
+    @items.setter
+    def items(self, value):
+        self._items = value
+
+    def tree_iter(self):
+        """Iterate over the leaves of this tree, parsing them one by
+        one if the tree hasn't been parsed yet."""
+        if self._items is not None:
+            return iter(self._items)
+        return self.tree_parse_iter(self.raw)
+
     def tree_parse(self, data):
+        return list(self.tree_parse_iter(data))
+
+    def tree_parse_iter(self, raw):
+        # We look for separators in the bytes, but decode paths straight
+        # from a memoryview, so the only things we allocate per entry
+        # are the leaf itself, its mode, path and 20 bytes SHA.
+        view = memoryview(raw)
         pos = 0
-        max = len(data)
-        ret = list()
+        max = len(raw)
         while pos < max:
-            pos, data = self.tree_parse_one(data, pos)
-            ret.append(data)
-        return ret
-    
-    def tree_parse_one(self, raw, start=0):
-        # Find the space terminator of the mode
-        x = raw.find(b' ', start)
-        assert x - start in [5, 6]
-
-        # Read the mode
-        mode = raw[start:x]
-        if len(mode) == 5:
-            # Normalize to six bytes.
-            mode = b" " + mode
-
-        # Find the NULL terminator of the path
-        y = raw.find(b'\x00', x)
-        # and read the path
-        path = raw[x+1:y]
-
-        # Read the SHA and convert to a hex string
-        sha = format(int.from_bytes(raw[y+1:y+21], "big"), "040x")
-        return y+21, GitTreeLeaf(mode, path.decode("utf8"), sha)
-    
+            # Find the space terminator of the mode
+            x = raw.find(b' ', pos)
+            assert x - pos in [5, 6]
+
+            # Read the mode, normalized to six bytes.
+            mode = raw[pos:x] if x - pos == 6 else b"0" + raw[pos:x]
+
+            # Find the NULL terminator of the path, and read the path
+            y = raw.find(b'\x00', x)
+            path = str(view[x+1:y], "utf8")
 
-    def tree_serialize(self, obj):
+            # The SHA is the next 20 bytes, kept as is.
+            yield GitTreeLeaf(mode, path, binsha=raw[y+1:y+21])
+            pos = y + 21
+
+    def tree_serialize(self):
         # Notice this isn't a comparison function, but a conversion function.
         # Python's default sort doesn't accept a custom comparison function,
         # like in most languages, but a `key` arguments that returns a new
         # value, which is compared using the default rules.  So we just return
         # the leaf name, with an extra / if it's a directory.
         def tree_leaf_sort_key(leaf):
-            if leaf.mode.startswith(b"10"):
-                return leaf.path
-            else:
+            if leaf.mode.startswith(b"04"):
                 return leaf.path + "/"
-        obj.items.sort(key=tree_leaf_sort_key)
-        ret = b''
-        for i in obj.items:
-            ret += i.mode
+            else:
+                return leaf.path
+        ret = bytearray()
+        for i in sorted(self.items, key=tree_leaf_sort_key):
+            # Modes are normalized to six digits, but git writes trees
+            # as "40000", without the leading zero.
+            ret += i.mode.lstrip(b"0")
             ret += b' '
             ret += i.path.encode("utf8")
             ret += b'\x00'
-            sha = int(i.sha, 16)
-            ret += sha.to_bytes(20, byteorder="big")
-        return ret
-    
+            ret += i.binsha
+        return bytes(ret)
+
 class GitTag(GitCommit):
     fmt = b'tag'
+
+
+class GitObjectCache(object):
+    """A LRU cache of parsed objects, keyed by SHA and bounded by the
+    total size of their raw contents.
+
+    Objects are immutable, so once read an object can be handed again
+    to anyone asking for the same SHA --- as long as callers don't
+    modify what they get.  Blobs larger than big_blob bypass the cache:
+    a few of them would evict every tree and commit we hold, and they
+    are rarely read twice anyway."""
+
+    def __init__(self, max_bytes, big_blob):
+        self.max_bytes = max_bytes
+        self.big_blob = big_blob
+        self.bytes = 0
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bypassed = 0
+
+    def get(self, sha):
+        ret = self.entries.get(sha)
+        if ret is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(sha)
+        return ret[0]
+
+    def info(self, sha):
+        """Return (fmt, size) if sha is cached, None otherwise.  This
+        is a cheap peek for object_info: it doesn't count as a hit and
+        doesn't refresh the entry."""
+        ret = self.entries.get(sha)
+        if ret is None:
+            return None
+        return ret[0].fmt, ret[1]
+
+    def put(self, sha, obj, size):
+        if sha in self.entries:
+            return
+        if size > self.max_bytes or (obj.fmt == b'blob' and size > self.big_blob):
+            self.bypassed += 1
+            return
+        self.entries[sha] = (obj, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, old) = self.entries.popitem(last=False)
+            self.bytes -= old
+            self.evictions += 1
+
+    def stats(self):
+        return { "objects": len(self.entries),
+                 "bytes": self.bytes,
+                 "max_bytes": self.max_bytes,
+                 "hits": self.hits,
+                 "misses": self.misses,
+                 "evictions": self.evictions,
+                 "bypassed": self.bypassed }
+
+    def trace(self, file=sys.stderr):
+        print("object cache: " + ", ".join("{}={}".format(k, v) for k, v in self.stats().items()), file=file)
+
+class GitObjectWriter(object):
+    """A pool of threads to hash, compress and write objects.  zlib and
+    hashlib release the GIL, so this actually uses several cores.
+
+    At most a few tasks per worker are queued at any time: submit()
+    blocks when the queue is full, so we never hold more than that many
+    objects in memory.  Tasks complete in any order, but submit()
+    returns futures, which callers consume in their own order, so the
+    result doesn't depend on scheduling."""
+
+    def __init__(self, workers):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(workers * 4)
+        self.futures = list()
+        # SHAs of objects already submitted, so identical objects are
+        # only written once.
+        self.submitted = set()
+
+    def submit(self, fn, *args):
+        self.slots.acquire()
+        future = self.pool.submit(fn, *args)
+        future.add_done_callback(lambda _: self.slots.release())
+        self.futures.append(future)
+        return future
+
+    def submit_once(self, sha, fn, *args):
+        """Like submit, but do nothing if sha was already submitted."""
+        if sha in self.submitted:
+            return None
+        self.submitted.add(sha)
+        return self.submit(fn, *args)
+
+    def close(self):
+        """Wait for all tasks, and raise the first error if any."""
+        self.pool.shutdown(wait=True)
+        for f in self.futures:
+            f.result()
@@ -0,0 +1,701 @@
+import bisect
+import collections
+import hashlib
+import mmap
+import os
+import tempfile
+import zlib
+
+# Object types, as stored in the 3-bit type field of a pack entry header.
+# 5 is reserved, 6 and 7 are deltas against another object.
+PACK_OBJ_COMMIT = 1
+PACK_OBJ_TREE = 2
+PACK_OBJ_BLOB = 3
+PACK_OBJ_TAG = 4
+PACK_OBJ_OFS_DELTA = 6
+PACK_OBJ_REF_DELTA = 7
+
+PACK_TYPE_FMT = { PACK_OBJ_COMMIT: b'commit',
+                  PACK_OBJ_TREE: b'tree',
+                  PACK_OBJ_BLOB: b'blob',
+                  PACK_OBJ_TAG: b'tag' }
+
+PACK_FMT_TYPE = { fmt: type for type, fmt in PACK_TYPE_FMT.items() }
+
+IDX_MAGIC = b'\377tOc'
+
+# Same default as git's core.deltaBaseCacheLimit.
+DELTA_BASE_CACHE_DEFAULT = 96 * 1024 * 1024
+
+def delta_varint(delta, pos):
+    """Read one of the two sizes at the start of a delta.  This is the
+    same little-endian varint as the entry header, without the type."""
+    ret = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        ret |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return ret, pos
+
+def delta_apply(base, delta):
+    """Rebuild an object from its base and a delta.  Both are read
+    through memoryviews, and the result is assembled in a bytearray of
+    the announced size, so no intermediate copies are made."""
+    base = memoryview(base)
+    delta = memoryview(delta)
+
+    src_size, pos = delta_varint(delta, 0)
+    if src_size != len(base):
+        raise Exception("Delta base size mismatch: expected {0}, got {1}".format(src_size, len(base)))
+    dst_size, pos = delta_varint(delta, pos)
+
+    out = bytearray(dst_size)
+    out_pos = 0
+    end = len(delta)
+
+    while pos < end:
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # Copy from base.  The low four bits tell which bytes of the
+            # offset are present, the next three which bytes of the size.
+            # Absent bytes are zero.
+            offset = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8*i)
+                    pos += 1
+            size = 0
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8*i)
+                    pos += 1
+            # A zero size means 64KiB, which can't be encoded otherwise.
+            if size == 0:
+                size = 0x10000
+            if offset + size > src_size or out_pos + size > dst_size:
+                raise Exception("Malformed delta: copy out of bounds")
+            out[out_pos:out_pos+size] = base[offset:offset+size]
+            out_pos += size
+        elif op:
+            # Insert the next op bytes of the delta itself.
+            if pos + op > end or out_pos + op > dst_size:
+                raise Exception("Malformed delta: insert out of bounds")
+            out[out_pos:out_pos+op] = delta[pos:pos+op]
+            pos += op
+            out_pos += op
+        else:
+            raise Exception("Malformed delta: reserved opcode 0")
+
+    if out_pos != dst_size:
+        raise Exception("Malformed delta: result size mismatch")
+
+    return bytes(out)
+
+class GitDeltaBaseCache(object):
+    """A LRU cache of objects rebuilt from packs, bounded by the total
+    size of their contents.  It's keyed by (pack path, offset), since
+    that's what OFS_DELTA entries point to.
+
+    Without it, reading N objects at the end of a delta chain of length
+    D inflates and applies N*D deltas; with it, walking history (where
+    each object is usually the base of the next one) costs about one
+    delta per object."""
+
+    def __init__(self, max_bytes=DELTA_BASE_CACHE_DEFAULT):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        ret = self.entries.get(key)
+        if ret is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return ret
+
+    def put(self, key, type, data):
+        # An object bigger than the whole cache would just flush it.
+        if len(data) > self.max_bytes or key in self.entries:
+            return
+        self.entries[key] = (type, data)
+        self.bytes += len(data)
+        while self.bytes > self.max_bytes:
+            _, (_, old) = self.entries.popitem(last=False)
+            self.bytes -= len(old)
+            self.evictions += 1
+
+class GitPackShaTable(object):
+    """A read-only sequence view over the sorted SHA table of an .idx
+    file.  It exists so we can hand it to the bisect module, which
+    accepts anything with __len__ and __getitem__: this way we never
+    copy the table, we only read the 20 bytes we compare against."""
+
+    def __init__(self, mm, base, count):
+        self.mm = mm
+        self.base = base
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        start = self.base + 20 * i
+        return self.mm[start:start+20]
+
+class GitPack(object):
+    """A packfile, with its v2 index.  Both files are memory-mapped:
+    the kernel pages in what we actually touch, which, for a lookup, is
+    a couple of pages of the index and the one entry we inflate."""
+
+    def __init__(self, idx_path, delta_cache=None):
+        self.idx_path = idx_path
+        self.pack_path = idx_path[:-4] + ".pack"
+
+        with open(idx_path, "rb") as f:
+            self.idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.idx[0:4] != IDX_MAGIC:
+            raise Exception("Unsupported pack index {0}: only v2 is supported".format(idx_path))
+        version = int.from_bytes(self.idx[4:8], "big")
+        if version != 2:
+            raise Exception("Unsupported pack index version {0} in {1}".format(version, idx_path))
+
+        # The fanout table is 256 big-endian counters: fanout[b] is the
+        # number of objects whose first SHA byte is <= b.  So the last
+        # one is the object count, and objects starting with byte b live
+        # between fanout[b-1] and fanout[b] in the sorted table.
+        self.fanout = [ int.from_bytes(self.idx[8+4*i:12+4*i], "big") for i in range(256) ]
+        self.count = self.fanout[255]
+
+        # Offsets of the tables that follow the fanout.
+        self.sha_base = 8 + 256*4
+        self.crc_base = self.sha_base + 20 * self.count
+        self.ofs_base = self.crc_base + 4 * self.count
+        self.ofs64_base = self.ofs_base + 4 * self.count
+
+        self.shas = GitPackShaTable(self.idx, self.sha_base, self.count)
+
+        # The pack itself is mapped the first time we need it.
+        self.pack = None
+
+        # Packs of the same repository share their delta base cache, so
+        # its size limit applies to all of them.
+        if delta_cache is None:
+            delta_cache = GitDeltaBaseCache()
+        self.delta_cache = delta_cache
+
+    def pack_map(self):
+        if self.pack is None:
+            with open(self.pack_path, "rb") as f:
+                self.pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if self.pack[0:4] != b'PACK':
+                raise Exception("Not a packfile {0}".format(self.pack_path))
+        return self.pack
+
+    def fanout_range(self, first_byte):
+        lo = self.fanout[first_byte-1] if first_byte > 0 else 0
+        return lo, self.fanout[first_byte]
+
+    def find(self, binsha):
+        """Return the position of binary SHA binsha in the index, or
+        None if this pack doesn't hold it."""
+        lo, hi = self.fanout_range(binsha[0])
+        i = bisect.bisect_left(self.shas, binsha, lo, hi)
+        if i < hi and self.shas[i] == binsha:
+            return i
+        return None
+
+    def find_prefix(self, prefix):
+        """Return the hex SHAs of all objects whose name starts with
+        prefix, an hex string of at least two characters."""
+        lo, hi = self.fanout_range(int(prefix[0:2], 16))
+        # Pad the prefix with zeros: this is the smallest SHA that can
+        # match, so bisect puts us on the first candidate.
+        start = bytes.fromhex((prefix + "0" * 40)[:40])
+        i = bisect.bisect_left(self.shas, start, lo, hi)
+        ret = list()
+        while i < hi:
+            sha = self.shas[i].hex()
+            if not sha.startswith(prefix):
+                break
+            ret.append(sha)
+            i += 1
+        return ret
+
+    def offset(self, i):
+        """Return the offset in the .pack of the i-th object."""
+        pos = self.ofs_base + 4*i
+        ofs = int.from_bytes(self.idx[pos:pos+4], "big")
+        # If the MSB is set, the remaining 31 bits are an index into
+        # the table of 64 bits offsets, for packs larger than 2GiB.
+        if ofs & 0x80000000:
+            pos = self.ofs64_base + 8 * (ofs & 0x7fffffff)
+            ofs = int.from_bytes(self.idx[pos:pos+8], "big")
+        return ofs
+
+    def entry_header(self, offset):
+        """Read the header of the entry at offset.  Return (type,
+        size, data_offset), where size is the *inflated* size."""
+        pack = self.pack_map()
+        c = pack[offset]
+        offset += 1
+        type = (c >> 4) & 0b111
+        size = c & 0b1111
+        shift = 4
+        # The size is a little-endian varint: seven bits per byte,
+        # the MSB telling whether another byte follows.
+        while c & 0x80:
+            c = pack[offset]
+            offset += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return type, size, offset
+
+    def inflate(self, offset, size):
+        """Inflate the zlib stream at offset, which is known to inflate
+        to size bytes.  We feed the decompressor memoryview slices of
+        the map, so the compressed data is never copied as a whole."""
+        view = memoryview(self.pack_map())
+        d = zlib.decompressobj()
+        parts = list()
+        # A zlib stream is rarely much bigger than its content, so the
+        # first chunk almost always holds all of it.
+        chunk = size + 64
+        while not d.eof:
+            if offset >= len(view):
+                raise Exception("Truncated pack entry in {0}".format(self.pack_path))
+            parts.append(d.decompress(view[offset:offset+chunk]))
+            offset += chunk
+            chunk = 65536
+        data = b''.join(parts)
+        if len(data) != size:
+            raise Exception("Malformed pack entry in {0}: bad length".format(self.pack_path))
+        return data
+
+    def inflate_chunks(self, offset, size, chunk_size):
+        """Like inflate, but yield the content by chunks of at most
+        chunk_size bytes instead of returning it whole."""
+        view = memoryview(self.pack_map())
+        d = zlib.decompressobj()
+        total = 0
+        while not d.eof:
+            if d.unconsumed_tail:
+                data = d.unconsumed_tail
+            else:
+                if offset >= len(view):
+                    raise Exception("Truncated pack entry in {0}".format(self.pack_path))
+                data = view[offset:offset+chunk_size]
+                offset += chunk_size
+            out = d.decompress(data, chunk_size)
+            total += len(out)
+            if out:
+                yield out
+        if total != size:
+            raise Exception("Malformed pack entry in {0}: bad length".format(self.pack_path))
+
+    def inflate_head(self, offset, n):
+        """Inflate at least the first n bytes of the zlib stream at
+        offset (fewer if the stream is shorter), without inflating the
+        rest."""
+        view = memoryview(self.pack_map())
+        d = zlib.decompressobj()
+        ret = b''
+        while len(ret) < n and not d.eof:
+            if d.unconsumed_tail:
+                data = d.unconsumed_tail
+            else:
+                if offset >= len(view):
+                    raise Exception("Truncated pack entry in {0}".format(self.pack_path))
+                data = view[offset:offset+64]
+                offset += 64
+            ret += d.decompress(data, n - len(ret))
+        return ret
+
+    def info(self, binsha):
+        """Return (fmt, size) for binary SHA binsha, or None, reading
+        only entry headers.  A delta's size is the result size written
+        at the start of the delta; its type is its base's, so we follow
+        the chain down, but only read headers on the way."""
+        i = self.find(binsha)
+        if i is None:
+            return None
+        offset = self.offset(i)
+        type, size, data_offset = self.entry_header(offset)
+
+        if type in (PACK_OBJ_OFS_DELTA, PACK_OBJ_REF_DELTA):
+            base_offset, data_offset = self.delta_base(offset, type, data_offset)
+            # Two varints of at most ten bytes each.
+            head = self.inflate_head(data_offset, 20)
+            _, pos = delta_varint(head, 0)
+            size, _ = delta_varint(head, pos)
+
+            offset = base_offset
+            while True:
+                type, _, data_offset = self.entry_header(offset)
+                if not type in (PACK_OBJ_OFS_DELTA, PACK_OBJ_REF_DELTA):
+                    break
+                offset, _ = self.delta_base(offset, type, data_offset)
+
+        if not type in PACK_TYPE_FMT:
+            raise Exception("Unknown pack entry type {0} in {1}".format(type, self.pack_path))
+        return PACK_TYPE_FMT[type], size
+
+    def delta_base(self, offset, type, data_offset):
+        """Locate the base of the delta entry at offset.  Return
+        (base_offset, delta_data_offset)."""
+        pack = self.pack_map()
+        if type == PACK_OBJ_OFS_DELTA:
+            # The base is at a negative offset from this entry, written
+            # as a big-endian varint where each continuation adds one
+            # before shifting (so that encodings are unique).
+            c = pack[data_offset]
+            data_offset += 1
+            rel = c & 0x7f
+            while c & 0x80:
+                c = pack[data_offset]
+                data_offset += 1
+                rel = ((rel + 1) << 7) | (c & 0x7f)
+            return offset - rel, data_offset
+        else:
+            # REF_DELTA: the base is named by its SHA.  Packs on disk
+            # are never thin, so the base must be in this very pack.
+            binsha = pack[data_offset:data_offset+20]
+            i = self.find(binsha)
+            if i is None:
+                raise Exception("Delta base {0} missing from {1}".format(binsha.hex(), self.pack_path))
+            return self.offset(i), data_offset + 20
+
+    def unpack(self, offset):
+        """Return (type, data) for the entry at offset, applying deltas
+        as needed.  We walk down the chain until we find either a full
+        object or a base we already have in cache, then apply deltas
+        back up, remembering each intermediate base on the way."""
+        chain = list()
+        while True:
+            cached = self.delta_cache.get((self.pack_path, offset))
+            if cached:
+                type, data = cached
+                break
+
+            type, size, data_offset = self.entry_header(offset)
+
+            if type in (PACK_OBJ_OFS_DELTA, PACK_OBJ_REF_DELTA):
+                base_offset, data_offset = self.delta_base(offset, type, data_offset)
+                chain.append((offset, data_offset, size))
+                offset = base_offset
+            elif type in PACK_TYPE_FMT:
+                data = self.inflate(data_offset, size)
+                if chain:
+                    self.delta_cache.put((self.pack_path, offset), type, data)
+                break
+            else:
+                raise Exception("Unknown pack entry type {0} in {1}".format(type, self.pack_path))
+
+        for i in range(len(chain)-1, -1, -1):
+            offset, data_offset, size = chain[i]
+            data = delta_apply(data, self.inflate(data_offset, size))
+            # The last object rebuilt is the one we were asked for, not
+            # a base: no need to cache it.
+            if i > 0:
+                self.delta_cache.put((self.pack_path, offset), type, data)
+
+        return type, data
+
+    def read(self, binsha):
+        """Return (fmt, data) for binary SHA binsha, or None."""
+        i = self.find(binsha)
+        if i is None:
+            return None
+        type, data = self.unpack(self.offset(i))
+        return PACK_TYPE_FMT[type], data
+
+    def stream(self, binsha, chunk_size):
+        """Return (fmt, size, chunks) for binary SHA binsha, or None,
+        where chunks iterates over the content.  Full objects are
+        inflated a chunk at a time.  Deltas need their whole base
+        anyway, so they are rebuilt in memory and come as one chunk."""
+        i = self.find(binsha)
+        if i is None:
+            return None
+        offset = self.offset(i)
+        type, size, data_offset = self.entry_header(offset)
+        if type in PACK_TYPE_FMT:
+            return PACK_TYPE_FMT[type], size, self.inflate_chunks(data_offset, size, chunk_size)
+        type, data = self.unpack(offset)
+        return PACK_TYPE_FMT[type], len(data), iter([data])
+
+def pack_open_all(objects_dir, delta_cache=None):
+    """Open every pack under objects_dir/pack.  Return a list of GitPack,
+    all sharing the same delta base cache."""
+    path = os.path.join(objects_dir, "pack")
+    if not os.path.isdir(path):
+        return list()
+
+    if delta_cache is None:
+        delta_cache = GitDeltaBaseCache()
+
+    ret = list()
+    for f in sorted(os.listdir(path)):
+        if f.endswith(".idx") and os.path.isfile(os.path.join(path, f[:-4] + ".pack")):
+            ret.append(GitPack(os.path.join(path, f), delta_cache))
+    return ret
+
+
+# Delta creation works on blocks of this many bytes: the base is indexed
+# one block at a time, and a match must be at least one block long.
+DELTA_BLOCK = 16
+
+# The largest copy a single instruction can encode (three size bytes).
+DELTA_MAX_COPY = 0xffffff
+
+def delta_varint_encode(n):
+    ret = bytearray()
+    while True:
+        c = n & 0x7f
+        n >>= 7
+        if n:
+            ret.append(c | 0x80)
+        else:
+            ret.append(c)
+            return ret
+
+def delta_match_length(a, ai, b, bi, limit):
+    """Count how many bytes a[ai:] and b[bi:] have in common, up to
+    limit.  We compare slices of decreasing sizes rather than bytes one
+    by one: long matches are the common case, and this keeps the loop
+    in C for most of them."""
+    n = 0
+    for step in (4096, 256, 16, 1):
+        while n + step <= limit and a[ai+n:ai+n+step] == b[bi+n:bi+n+step]:
+            n += step
+    return n
+
+def delta_create(base, target, max_size=None):
+    """Return a delta rebuilding target from base, in the format
+    delta_apply reads, or None if it would be larger than max_size.
+
+    This is a much simplified version of git's diff-delta: we index the
+    base by non-overlapping blocks, then walk the target looking up the
+    block starting at each position.  On a hit we extend the match and
+    emit a copy, otherwise the byte goes to the pending insert."""
+    index = dict()
+    for i in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK):
+        block = base[i:i+DELTA_BLOCK]
+        if not block in index:
+            index[block] = i
+
+    out = delta_varint_encode(len(base)) + delta_varint_encode(len(target))
+    pending = 0 # Start of the bytes waiting to be inserted
+    pos = 0
+    end = len(target)
+
+    def flush_insert(start, stop):
+        while start < stop:
+            n = min(stop - start, 0x7f)
+            out.append(n)
+            out.extend(target[start:start+n])
+            start += n
+
+    while pos < end:
+        bo = index.get(target[pos:pos+DELTA_BLOCK]) if end - pos >= DELTA_BLOCK else None
+        if bo is None:
+            pos += 1
+            if max_size is not None and len(out) + (pos - pending) > max_size:
+                return None
+            continue
+
+        length = delta_match_length(base, bo, target, pos, min(len(base) - bo, end - pos))
+        flush_insert(pending, pos)
+
+        while length > 0:
+            size = min(length, DELTA_MAX_COPY)
+            op = 0x80
+            args = bytearray()
+            for i in range(4):
+                byte = (bo >> (8*i)) & 0xff
+                if byte:
+                    op |= 1 << i
+                    args.append(byte)
+            for i in range(3):
+                byte = (size >> (8*i)) & 0xff
+                if byte:
+                    op |= 0x10 << i
+                    args.append(byte)
+            out.append(op)
+            out.extend(args)
+            bo += size
+            pos += size
+            length -= size
+        pending = pos
+
+        if max_size is not None and len(out) > max_size:
+            return None
+
+    flush_insert(pending, end)
+
+    if max_size is not None and len(out) > max_size:
+        return None
+    return bytes(out)
+
+def pack_compress_segment(segment, window=10, depth=50, big_file_threshold=512*1024**2):
+    """Find deltas and compress a segment of objects to be packed.
+
+    segment is a list of (sha, type, data), already sorted so that
+    similar objects are close to each other.  Each object is tried
+    against the window objects before it, and stored as a delta against
+    the one giving the smallest result, if any is worth it.  Return a
+    list of (sha, type, base_sha, compressed, size), where base_sha is
+    None for full objects and size is the size of what was compressed.
+
+    This is a plain function on plain data, so segments can be handed
+    to a process pool."""
+    ret = list()
+    depths = list()
+    for i, (sha, type, data) in enumerate(segment):
+        best = None
+        best_j = None
+        # Like git, we only want deltas that save at least half the
+        # object: otherwise the extra indirection isn't worth it.
+        max_size = len(data) // 2 - 20
+        if max_size > 0 and len(data) <= big_file_threshold:
+            for j in range(i-1, max(0, i-window)-1, -1):
+                base_sha, base_type, base = segment[j]
+                if base_type != type or depths[j] >= depth:
+                    continue
+                if len(base) > big_file_threshold:
+                    continue
+                # The size difference alone would have to be inserted.
+                if len(data) - len(base) >= max_size:
+                    continue
+                delta = delta_create(base, data, max_size if best is None else len(best) - 1)
+                if delta is not None:
+                    best = delta
+                    best_j = j
+
+        if best is not None:
+            ret.append((sha, type, segment[best_j][0], zlib.compress(best), len(best)))
+            depths.append(depths[best_j] + 1)
+        else:
+            ret.append((sha, type, None, zlib.compress(data), len(data)))
+            depths.append(0)
+    return ret
+
+def pack_entry_header(type, size):
+    """Encode the header of a pack entry, the reverse of
+    GitPack.entry_header."""
+    c = (type << 4) | (size & 0b1111)
+    size >>= 4
+    ret = bytearray()
+    while size:
+        ret.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    ret.append(c)
+    return ret
+
+def pack_ofs_encode(rel):
+    """Encode the relative offset of an OFS_DELTA base, the reverse of
+    what GitPack.delta_base decodes."""
+    ret = bytearray([rel & 0x7f])
+    rel >>= 7
+    while rel:
+        rel -= 1
+        ret.insert(0, 0x80 | (rel & 0x7f))
+        rel >>= 7
+    return ret
+
+def pack_write(pack_dir, entries, count):
+    """Write a pack and its v2 index in pack_dir.
+
+    entries is an iterable of count tuples, as returned by
+    pack_compress_segment, where each delta's base comes before the
+    delta itself.  Both files are written under temporary names and
+    renamed once complete, the pack first: a reader only looks for
+    packs that have an index.  Return the path of the new .pack and
+    the list of the hex SHAs it holds."""
+    os.makedirs(pack_dir, exist_ok=True)
+
+    offsets = dict()
+    crcs = dict()
+
+    fd, tmp_pack = tempfile.mkstemp(dir=pack_dir, prefix="tmp_pack_")
+    with os.fdopen(fd, "wb") as f:
+        checksum = hashlib.sha1()
+
+        def write(data):
+            checksum.update(data)
+            f.write(data)
+
+        write(b'PACK' + (2).to_bytes(4, "big") + count.to_bytes(4, "big"))
+        pos = 12
+        for (sha, type, base_sha, compressed, size) in entries:
+            if base_sha is None:
+                head = pack_entry_header(type, size)
+            else:
+                head = pack_entry_header(PACK_OBJ_OFS_DELTA, size)
+                head += pack_ofs_encode(pos - offsets[base_sha])
+            write(head)
+            write(compressed)
+            offsets[sha] = pos
+            crcs[sha] = zlib.crc32(compressed, zlib.crc32(head))
+            pos += len(head) + len(compressed)
+
+        if len(offsets) != count:
+            raise Exception("Pack should hold {0} objects, got {1}".format(count, len(offsets)))
+
+        pack_sha = checksum.digest()
+        f.write(pack_sha)
+
+    name = os.path.join(pack_dir, "pack-" + pack_sha.hex())
+
+    shas = sorted(offsets.keys())
+    binshas = [ bytes.fromhex(sha) for sha in shas ]
+
+    idx = bytearray(IDX_MAGIC + (2).to_bytes(4, "big"))
+
+    fanout = [0] * 256
+    for binsha in binshas:
+        fanout[binsha[0]] += 1
+    total = 0
+    for n in fanout:
+        total += n
+        idx += total.to_bytes(4, "big")
+
+    for binsha in binshas:
+        idx += binsha
+    for sha in shas:
+        idx += crcs[sha].to_bytes(4, "big")
+
+    large = bytearray()
+    for sha in shas:
+        ofs = offsets[sha]
+        if ofs < 0x80000000:
+            idx += ofs.to_bytes(4, "big")
+        else:
+            idx += (0x80000000 | (len(large) // 8)).to_bytes(4, "big")
+            large += ofs.to_bytes(8, "big")
+    idx += large
+
+    idx += pack_sha
+    idx += hashlib.sha1(idx).digest()
+
+    fd, tmp_idx = tempfile.mkstemp(dir=pack_dir, prefix="tmp_idx_")
+    with os.fdopen(fd, "wb") as f:
+        f.write(idx)
+
+    # mkstemp creates files readable by their owner only.
+    os.chmod(tmp_pack, 0o444)
+    os.chmod(tmp_idx, 0o444)
+    os.replace(tmp_pack, name + ".pack")
+    os.replace(tmp_idx, name + ".idx")
+
+    return name + ".pack", shas
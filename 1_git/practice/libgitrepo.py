@@ -1,29 +1,345 @@
 
 
+from array import array
+import atexit
+import bisect
 import configparser
+import ctypes
+import hashlib
+import io
 from math import ceil
 import os
 import re
+import struct
 import sys
+import threading
+from libgitpack import pack_open_all, pack_ofs_encode, GitDeltaBaseCache, DELTA_BASE_CACHE_DEFAULT
+from libgitobj import GitObjectCache
+
+# Extended flags (index version 3 and up) are kept in the high 16 bits
+# of the flags column.  Skip-worktree marks entries outside the sparse
+# checkout: they're in the index, but not expected in the worktree.
+INDEX_SKIP_WORKTREE = 0x4000 << 16
+# The mode of a sparse directory entry: a whole tree outside the sparse
+# checkout, in a single entry (whose name ends with a /).
+INDEX_SPARSE_DIR_MODE = 0o040000
 
 class GitIndex (object):
+    """The index, stored by columns rather than as a list of objects.
+
+    Each fixed-size field of the entries lives in its own array of 32
+    bits integers (that's their size on disk anyway), SHAs are
+    concatenated in a single bytearray and names are kept in a list.
+    For a large index, this costs a fraction of the memory of one
+    Python object per entry.
+
+    The entries attribute still behaves like a list of GitIndexEntry:
+    entries are materialized when accessed.  They are copies, so to
+    modify one, assign it back (index.entries[i] = e).
+
+    To find entries by path, use find() and under(): they go through
+    the positions of the entries sorted by path (see order()) and a
+    dictionary from names to positions, both built on first use and
+    dropped whenever entries are added, changed or removed."""
     version = None
-    entries = []
     # ext = None
     # sha = None
 
     def __init__(self, version=2, entries=None):
-        if not entries:
-            entries = list()
-
         self.version = version
-        self.entries = entries
+        # The root GitCacheTree, from the TREE extension, if any.
+        self.cache_tree = None
+        # The GitUntrackedCache, from the UNTR extension, if any.
+        self.untracked_cache = None
+        # From the FSMN extension: the token of the last answer of the
+        # monitor (see libgitmonitor), and the names of the entries
+        # which didn't match the worktree then, or were touched since.
+        # The others are known to match, as long as the monitor reports
+        # no change for them.
+        self.fsmonitor_token = None
+        self.fsmonitor_dirty = set()
+        # The mtime of the index file we were read from, in nanoseconds.
+        self.timestamp = None
+        # The names of the entries whose stat data we took ourselves
+        # (added, or refreshed), rather than read from the file: they're
+        # never racy (see smudge_racy).
+        self.fresh = set()
+        self.clear()
+        if entries:
+            self.entries = entries
+
+    def clear(self):
+        self.ctime_s = array("I")
+        self.ctime_ns = array("I")
+        self.mtime_s = array("I")
+        self.mtime_ns = array("I")
+        self.dev = array("I")
+        self.ino = array("I")
+        # mode_type << 12 | mode_perms, as on disk.
+        self.mode = array("I")
+        self.uid = array("I")
+        self.gid = array("I")
+        self.fsize = array("I")
+        # Assume-valid and stage bits of the flags, and extended flags
+        # << 16; the name length isn't stored, we have the name.
+        self.flags = array("I")
+        # 20 bytes per entry.
+        self.shas = bytearray()
+        self.names = list()
+        self.lookup_drop()
+
+    def lookup_drop(self):
+        # Positions of the entries sorted by path then stage, the names
+        # in the same order, and name -> position of its first entry.
+        self.sorted_pos = None
+        self.sorted_names = None
+        self.positions = None
+
+    def lookup_build(self):
+        if self.positions is not None:
+            return
+        names = self.names
+        flags = self.flags
+        # Code points sort like the UTF-8 bytes git sorts on.
+        self.sorted_pos = sorted(range(len(names)), key=lambda i: (names[i], flags[i] & 0b0011000000000000))
+        self.sorted_names = [names[i] for i in self.sorted_pos]
+        self.positions = dict()
+        for i in reversed(self.sorted_pos):
+            self.positions[names[i]] = i
+
+    def order(self):
+        """Return the positions of the entries, sorted like git wants
+        them: by name, then stage."""
+        self.lookup_build()
+        return self.sorted_pos
+
+    def find(self, name):
+        """Return the position of the entry for path name (the lowest
+        stage if there are several), or None."""
+        self.lookup_build()
+        return self.positions.get(name)
+
+    def find_all(self, name):
+        """Return the positions of every entry (one per stage) for path
+        name."""
+        self.lookup_build()
+        start = bisect.bisect_left(self.sorted_names, name)
+        end = bisect.bisect_right(self.sorted_names, name, start)
+        return self.sorted_pos[start:end]
+
+    def under(self, path):
+        """Return the (start, end) range of order() holding the entries
+        below directory path ("" for all of them)."""
+        self.lookup_build()
+        if not path:
+            return (0, len(self.names))
+        start = bisect.bisect_left(self.sorted_names, path + "/")
+        end = bisect.bisect_left(self.sorted_names, path + "0", start) # "0" follows "/"
+        return (start, end)
+
+    def stat_matches(self, i, st):
+        """Return True if the stat data of entry i matches st, the lstat
+        of its file, so its content can be assumed unchanged.
+
+        An entry whose file was modified in the same instant the index
+        was written (or after) is racy: it could have changed again
+        afterwards without its mtime changing, so it never matches."""
+        mtime_ns = st.st_mtime_ns
+        if self.timestamp is not None and mtime_ns >= self.timestamp:
+            return False
+        ctime_ns = st.st_ctime_ns
+        return (self.mtime_s[i] == (mtime_ns // 10**9) & 0xFFFFFFFF
+                and self.mtime_ns[i] == mtime_ns % 10**9
+                and self.ctime_s[i] == (ctime_ns // 10**9) & 0xFFFFFFFF
+                and self.ctime_ns[i] == ctime_ns % 10**9
+                and self.fsize[i] == st.st_size & 0xFFFFFFFF
+                and self.ino[i] == st.st_ino & 0xFFFFFFFF)
+
+    def set_stat(self, i, st):
+        """Replace the stat data of entry i with st, an lstat of its
+        file whose content matches the entry."""
+        self.ctime_s[i] = (st.st_ctime_ns // 10**9) & 0xFFFFFFFF
+        self.ctime_ns[i] = st.st_ctime_ns % 10**9
+        self.mtime_s[i] = (st.st_mtime_ns // 10**9) & 0xFFFFFFFF
+        self.mtime_ns[i] = st.st_mtime_ns % 10**9
+        self.dev[i] = st.st_dev & 0xFFFFFFFF
+        self.ino[i] = st.st_ino & 0xFFFFFFFF
+        self.uid[i] = st.st_uid & 0xFFFFFFFF
+        self.gid[i] = st.st_gid & 0xFFFFFFFF
+        self.fsize[i] = st.st_size & 0xFFFFFFFF
+        self.fresh.add(self.names[i])
+
+    def smudge_racy(self):
+        """Before writing: make the racy entries we're keeping as they
+        were read never match their file again.
+
+        An entry is racy if its file was modified no earlier than the
+        index was written (see stat_matches): the file may have changed
+        again without its mtime changing.  This is caught when reading
+        that index, but once we've written another one, newer than the
+        file, it wouldn't be.  So, like git, we set its size to 0 (empty
+        files aside, the size won't match anymore), and the next status
+        will compare the content.  Entries whose stat data we took
+        ourselves are left alone: the new index's timestamp protects
+        them."""
+        if self.timestamp is None:
+            return
+        mtime_s, mtime_ns = self.mtime_s, self.mtime_ns
+        timestamp_s, timestamp_ns = divmod(self.timestamp, 10**9)
+        for i in range(len(self.names)):
+            if (mtime_s[i] > timestamp_s or mtime_s[i] == timestamp_s and mtime_ns[i] >= timestamp_ns) \
+               and not self.names[i] in self.fresh:
+                self.fsize[i] = 0
+
+    def remove(self, positions):
+        """Remove the entries at positions."""
+        positions = set(positions)
+        if not positions:
+            return
+        keep = [i for i in range(len(self.names)) if not i in positions]
+        for col in ("ctime_s", "ctime_ns", "mtime_s", "mtime_ns", "dev", "ino",
+                    "mode", "uid", "gid", "fsize", "flags"):
+            old = getattr(self, col)
+            setattr(self, col, array("I", [old[i] for i in keep]))
+        shas = self.shas
+        self.shas = bytearray(b"".join([shas[20*i:20*i+20] for i in keep]))
+        self.names = [self.names[i] for i in keep]
+        self.lookup_drop()
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def entries(self):
+        return GitIndexEntries(self)
+
+    @entries.setter
+    def entries(self, entries):
+        # entries may be a view on ourselves: copy before clearing.
+        entries = list(entries)
+        fresh = self.fresh
+        self.clear()
+        for e in entries:
+            self.append(e)
+        self.fresh = fresh
+
+    def append_fields(self, ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino,
+                      mode, uid, gid, fsize, binsha, flags, name):
+        # The index only has room for 32 bits: like git, we keep the low
+        # bits of what doesn't fit (eg, 64 bits inode numbers).
+        self.ctime_s.append(ctime_s & 0xFFFFFFFF)
+        self.ctime_ns.append(ctime_ns & 0xFFFFFFFF)
+        self.mtime_s.append(mtime_s & 0xFFFFFFFF)
+        self.mtime_ns.append(mtime_ns & 0xFFFFFFFF)
+        self.dev.append(dev & 0xFFFFFFFF)
+        self.ino.append(ino & 0xFFFFFFFF)
+        self.mode.append(mode)
+        self.uid.append(uid & 0xFFFFFFFF)
+        self.gid.append(gid & 0xFFFFFFFF)
+        self.fsize.append(fsize & 0xFFFFFFFF)
+        self.shas += binsha
+        self.flags.append(flags)
+        self.names.append(name)
+        if self.positions is not None:
+            self.lookup_drop()
+
+    def invalidate_path(self, name):
+        """Record that the entry for path name was added, removed or
+        changed: the cached trees containing it are now wrong, and so
+        are the untracked files of its directory."""
+        if self.cache_tree is not None:
+            self.cache_tree.invalidate(name)
+        if self.untracked_cache is not None:
+            self.untracked_cache.invalidate(name)
+        if self.fsmonitor_token is not None:
+            self.fsmonitor_dirty.add(name)
+
+    def entry_flags(self, e):
+        return ((0x8000 if e.flag_assume_valid else 0) | (e.flag_stage or 0)
+                | (INDEX_SKIP_WORKTREE if e.flag_skip_worktree else 0))
+
+    def append(self, e):
+        self.fresh.add(e.name)
+        self.append_fields(e.ctime[0], e.ctime[1], e.mtime[0], e.mtime[1], e.dev, e.ino,
+                           (e.mode_type << 12) | e.mode_perms, e.uid, e.gid, e.fsize,
+                           bytes.fromhex(e.sha), self.entry_flags(e), e.name)
+
+    def entry(self, i):
+        """Materialize the i-th entry as a GitIndexEntry."""
+        mode = self.mode[i]
+        flags = self.flags[i]
+        return GitIndexEntry(ctime=(self.ctime_s[i], self.ctime_ns[i]),
+                             mtime=(self.mtime_s[i], self.mtime_ns[i]),
+                             dev=self.dev[i],
+                             ino=self.ino[i],
+                             mode_type=mode >> 12,
+                             mode_perms=mode & 0b0000000111111111,
+                             uid=self.uid[i],
+                             gid=self.gid[i],
+                             fsize=self.fsize[i],
+                             sha=self.shas[20*i:20*i+20].hex(),
+                             flag_assume_valid=(flags & 0x8000) != 0,
+                             flag_stage=flags & 0b0011000000000000,
+                             flag_skip_worktree=(flags & INDEX_SKIP_WORKTREE) != 0,
+                             name=self.names[i])
+
+    def set_entry(self, i, e):
+        self.fresh.add(e.name)
+        self.ctime_s[i] = e.ctime[0] & 0xFFFFFFFF
+        self.ctime_ns[i] = e.ctime[1] & 0xFFFFFFFF
+        self.mtime_s[i] = e.mtime[0] & 0xFFFFFFFF
+        self.mtime_ns[i] = e.mtime[1] & 0xFFFFFFFF
+        self.dev[i] = e.dev & 0xFFFFFFFF
+        self.ino[i] = e.ino & 0xFFFFFFFF
+        self.mode[i] = (e.mode_type << 12) | e.mode_perms
+        self.uid[i] = e.uid & 0xFFFFFFFF
+        self.gid[i] = e.gid & 0xFFFFFFFF
+        self.fsize[i] = e.fsize & 0xFFFFFFFF
+        self.shas[20*i:20*i+20] = bytes.fromhex(e.sha)
+        flags = self.entry_flags(e)
+        if self.names[i] != e.name or (self.flags[i] ^ flags) & 0b0011000000000000:
+            self.lookup_drop()
+        self.flags[i] = flags
+        self.names[i] = e.name
+
+class GitIndexEntries (object):
+    """A list-like view of the entries of a GitIndex."""
+    __slots__ = ("index",)
+
+    def __init__(self, index):
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.index)
+        if not 0 <= i < len(self.index):
+            raise IndexError("index entry out of range")
+        return self.index.entry(i)
+
+    def __setitem__(self, i, e):
+        if i < 0:
+            i += len(self.index)
+        self.index.set_entry(i, e)
+
+    def __iter__(self):
+        for i in range(len(self.index)):
+            yield self.index.entry(i)
+
+    def append(self, e):
+        self.index.append(e)
 
 class GitIndexEntry (object):
+    __slots__ = ("ctime", "mtime", "dev", "ino", "mode_type", "mode_perms",
+                 "uid", "gid", "fsize", "sha", "flag_assume_valid",
+                 "flag_stage", "flag_skip_worktree", "name")
+
     def __init__(self, ctime=None, mtime=None, dev=None, ino=None,
                  mode_type=None, mode_perms=None, uid=None, gid=None,
                  fsize=None, sha=None, flag_assume_valid=None,
-                 flag_stage=None, name=None):
+                 flag_stage=None, flag_skip_worktree=False, name=None):
       # The last time a file's metadata changed.  This is a pair
       # (timestamp in seconds, nanoseconds)
       self.ctime = ctime
@@ -35,7 +351,7 @@ class GitIndexEntry (object):
       # The file's inode number
       self.ino = ino
       # The object type, either b1000 (regular), b1010 (symlink),
-      # b1110 (gitlink).
+      # b1110 (gitlink), or b0100 for a sparse directory.
       self.mode_type = mode_type
       # The object permissions, an integer.
       self.mode_perms = mode_perms
@@ -49,15 +365,545 @@ class GitIndexEntry (object):
       self.sha = sha
       self.flag_assume_valid = flag_assume_valid
       self.flag_stage = flag_stage
+      # Outside the sparse checkout: not expected in the worktree.
+      self.flag_skip_worktree = flag_skip_worktree
       # Name of the object (full path this time!)
       self.name = name
-   
+
+class GitCacheTree (object):
+    """A node of the cached tree, stored in the TREE extension of the
+    index: the SHA of the tree object for one directory, and the number
+    of index entries below it, so a commit can reuse a tree as is
+    instead of rebuilding it.  entry_count is -1 when the tree isn't
+    known (or not anymore, because something below changed).
+
+    In the index, each node is written as: its name relative to its
+    parent (empty for the root), a NUL, the entry count and the number
+    of subtrees in ASCII, separated by a space, a newline, then the
+    binary SHA if the entry count isn't -1.  Subtrees follow, depth
+    first."""
+    __slots__ = ("entry_count", "binsha", "subtrees")
+
+    def __init__(self, entry_count=-1, binsha=None):
+        self.entry_count = entry_count
+        self.binsha = binsha
+        # Name -> GitCacheTree
+        self.subtrees = dict()
+
+    def valid(self):
+        return self.entry_count >= 0
+
+    def invalidate(self, path):
+        """Forget the trees containing path, that is every directory from
+        the root down to path's parent."""
+        node = self
+        node.entry_count = -1
+        for name in path.split("/")[:-1]:
+            node = node.subtrees.get(name)
+            if node is None:
+                return
+            node.entry_count = -1
+
+    def serialize(self, out, name=b""):
+        out += name + b"\x00" + "{0} {1}\n".format(self.entry_count, len(self.subtrees)).encode("ascii")
+        if self.valid():
+            out += self.binsha
+        for subname, sub in self.subtrees.items():
+            sub.serialize(out, subname.encode("utf8"))
+        return out
+
+def cache_tree_parse(raw):
+    """Parse the data of a TREE extension, return the root GitCacheTree."""
+    pos = 0
+    def parse_node():
+        nonlocal pos
+        nul = raw.find(b"\x00", pos)
+        nl = raw.find(b"\n", nul)
+        name = raw[pos:nul].decode("utf8")
+        entry_count, sub_count = [int(x) for x in raw[nul+1:nl].split(b" ")]
+        pos = nl + 1
+        node = GitCacheTree(entry_count)
+        if entry_count >= 0:
+            node.binsha = bytes(raw[pos:pos+20])
+            pos += 20
+        for i in range(sub_count):
+            subname, sub = parse_node()
+            node.subtrees[subname] = sub
+        return name, node
+    return parse_node()[1]
+
+def varint_decode(raw, pos):
+    """Decode the varint at raw[pos], the encoding git uses in the
+    index (and for OFS_DELTA offsets in packs, see pack_ofs_encode).
+    Return the value and the position following it."""
+    c = raw[pos]
+    pos += 1
+    value = c & 0x7f
+    while c & 0x80:
+        c = raw[pos]
+        pos += 1
+        value = ((value + 1) << 7) | (c & 0x7f)
+    return value, pos
+
+def ewah_serialize(bits, count, out):
+    """Append to out the bitmap of count bits whose set bits are the
+    positions in bits, in git's EWAH format: the number of bits, the
+    number of 64 bits words, the words, and the position of the last
+    "running length word".  Words either describe a run of identical
+    words, or say how many literal words follow; we don't bother with
+    runs and write a single header word followed by all the bits."""
+    words = [0] * ((count + 63) // 64)
+    for bit in bits:
+        words[bit // 64] |= 1 << (bit % 64)
+    out += struct.pack(">II", count, len(words) + 1)
+    out += struct.pack(">{0}Q".format(len(words) + 1), len(words) << 33, *words)
+    out += struct.pack(">I", 0)
+    return out
+
+def ewah_parse(raw, pos):
+    """Parse the EWAH bitmap at raw[pos].  Return the list of the
+    positions of its set bits, and the position following it."""
+    count, word_count = struct.unpack_from(">II", raw, pos)
+    words = struct.unpack_from(">{0}Q".format(word_count), raw, pos + 8)
+    bits = list()
+    base = 0
+    i = 0
+    while i < word_count:
+        # Running length word: a run of words of all zeroes or all
+        # ones, followed by a number of literal words.
+        rlw = words[i]
+        run_length = (rlw >> 1) & 0xFFFFFFFF
+        if rlw & 1:
+            bits.extend(range(base, base + 64 * run_length))
+        base += 64 * run_length
+        for word in words[i+1:i+1+(rlw >> 33)]:
+            for b in range(64):
+                if word >> b & 1:
+                    bits.append(base + b)
+            base += 64
+        i += 1 + (rlw >> 33)
+    return [bit for bit in bits if bit < count], pos + 8 + 8 * word_count + 4
+
+def stat_data(st):
+    """The stat data git stores for a file or directory, as a tuple of
+    32 bits integers: ctime and mtime (seconds and nanoseconds), device,
+    inode, uid, gid and size.  Most of them are truncated, but that's
+    enough to notice changes."""
+    return tuple(x & 0xFFFFFFFF for x in
+                 (int(st.st_ctime), st.st_ctime_ns % 10**9,
+                  int(st.st_mtime), st.st_mtime_ns % 10**9,
+                  st.st_dev, st.st_ino, st.st_uid, st.st_gid, st.st_size))
+
+class GitUntrackedDir (object):
+    """A directory in the untracked cache."""
+    __slots__ = ("valid", "stat", "exclude_sha", "untracked", "subdirs")
+
+    def __init__(self):
+        # Whether stat and untracked can be trusted.
+        self.valid = False
+        # The stat_data of the directory when it was listed: as long as
+        # it doesn't change, no entry was added or removed.
+        self.stat = None
+        # The binary SHA of the directory's .gitignore (None if it has
+        # none): if it changes, so may the untracked files of the
+        # directory and all its subdirectories.
+        self.exclude_sha = None
+        # The names of the untracked files in the directory.
+        self.untracked = list()
+        # Name -> GitUntrackedDir
+        self.subdirs = dict()
+
+class GitUntrackedCache (object):
+    """The untracked cache, stored in the UNTR extension of the index.
+
+    It remembers, for each directory of the worktree, its stat data
+    and its untracked files, so that status only lists the directories
+    whose stat data changed, rather than walking the whole worktree
+    and matching every file against the ignore rules.  It's dropped
+    as a whole if the global ignore files change, or if the worktree
+    moves (that's the ident)."""
+
+    # The dir_flags git records the options of the walk in.  wyag's
+    # ignore rules are simpler than git's, so we use a value git never
+    # runs with: it will rebuild its own cache rather than trust ours.
+    DIR_FLAGS = 0x1
+
+    def __init__(self, ident):
+        self.ident = ident
+        # (stat_data, binary SHA) of info/exclude and of the global
+        # ignore file; (None, None) when they don't exist.
+        self.info_exclude = (None, None)
+        self.excludes_file = (None, None)
+        self.dir_flags = self.DIR_FLAGS
+        self.exclude_per_dir = b".gitignore"
+        self.root = None
+
+    def invalidate(self, path):
+        """Forget the untracked files of every directory from the root to
+        path's parent, because path was added to or removed from the
+        index."""
+        node = self.root
+        for name in path.split("/"):
+            if node is None:
+                return
+            node.valid = False
+            node = node.subdirs.get(name)
+
+    def serialize(self, out):
+        null = bytes(20)
+        out += pack_ofs_encode(len(self.ident)) + self.ident
+        for (stat, binsha) in (self.info_exclude, self.excludes_file):
+            out += struct.pack(">9I", *(stat or (0,) * 9))
+        out += struct.pack(">I", self.dir_flags)
+        out += (self.info_exclude[1] or null) + (self.excludes_file[1] or null)
+        out += self.exclude_per_dir + b"\x00"
+        if self.root is None:
+            out += pack_ofs_encode(0)
+            return out
+
+        # Directories are written depth first: their names, untracked
+        # files and number of subdirectories, then bitmaps saying which
+        # are valid, and which have a .gitignore, then stat data for the
+        # valid ones and SHAs for those with a .gitignore.
+        dirs = bytearray()
+        valid = list()
+        stats = bytearray()
+        shas = bytearray()
+        count = 0
+        def write_dir(name, node):
+            nonlocal count
+            if node.valid:
+                valid.append(count)
+                stats.extend(struct.pack(">9I", *node.stat))
+            else:
+                node.untracked = list()
+            if node.exclude_sha:
+                shas_valid.append(count)
+                shas.extend(node.exclude_sha)
+            count += 1
+            dirs.extend(pack_ofs_encode(len(node.untracked)))
+            dirs.extend(pack_ofs_encode(len(node.subdirs)))
+            dirs.extend(name + b"\x00")
+            for f in node.untracked:
+                dirs.extend(f.encode("utf8") + b"\x00")
+            for subname, sub in node.subdirs.items():
+                write_dir(subname.encode("utf8"), sub)
+        shas_valid = list()
+        write_dir(b"", self.root)
+
+        out += pack_ofs_encode(count) + dirs
+        ewah_serialize(valid, count, out)
+        # "Check only" directories: we have none.
+        ewah_serialize([], count, out)
+        ewah_serialize(shas_valid, count, out)
+        out += stats + shas + b"\x00"
+        return out
+
+def untracked_cache_parse(raw):
+    """Parse the data of an UNTR extension, return a GitUntrackedCache."""
+    ident_len, pos = varint_decode(raw, 0)
+    ret = GitUntrackedCache(bytes(raw[pos:pos+ident_len]))
+    pos += ident_len
+    stats = struct.unpack_from(">18I", raw, pos)
+    ret.dir_flags, = struct.unpack_from(">I", raw, pos + 72)
+    shas = (bytes(raw[pos+76:pos+96]), bytes(raw[pos+96:pos+116]))
+    null = bytes(20)
+    ret.info_exclude = (stats[:9], shas[0]) if shas[0] != null else (None, None)
+    ret.excludes_file = (stats[9:], shas[1]) if shas[1] != null else (None, None)
+    pos += 116
+    nul = raw.find(b"\x00", pos)
+    ret.exclude_per_dir = bytes(raw[pos:nul])
+    count, pos = varint_decode(raw, nul + 1)
+    if count == 0:
+        return ret
+
+    nodes = list()
+    def parse_dir():
+        nonlocal pos
+        node = GitUntrackedDir()
+        nodes.append(node)
+        untracked_count, pos = varint_decode(raw, pos)
+        subdir_count, pos = varint_decode(raw, pos)
+        nul = raw.find(b"\x00", pos)
+        name = raw[pos:nul].decode("utf8")
+        pos = nul + 1
+        for i in range(untracked_count):
+            nul = raw.find(b"\x00", pos)
+            node.untracked.append(raw[pos:nul].decode("utf8"))
+            pos = nul + 1
+        for i in range(subdir_count):
+            subname, sub = parse_dir()
+            node.subdirs[subname] = sub
+        return name, node
+    ret.root = parse_dir()[1]
+
+    valid, pos = ewah_parse(raw, pos)
+    _, pos = ewah_parse(raw, pos)
+    shas_valid, pos = ewah_parse(raw, pos)
+    for i in valid:
+        nodes[i].valid = True
+        nodes[i].stat = struct.unpack_from(">9I", raw, pos)
+        pos += 36
+    for i in shas_valid:
+        nodes[i].exclude_sha = bytes(raw[pos:pos+20])
+        pos += 20
+    return ret
+
+class GitSparseCone (object):
+    """The directories of a cone-mode sparse checkout, as stored in
+    .git/info/sparse-checkout.
+
+    Cone mode only selects whole directories: the recursive ones, with
+    everything below them.  Their ancestors are "parents": the files
+    directly in them are included too (so, always, the files at the
+    root of the worktree), but not their other subdirectories.  So
+    whether a path is included only depends on its directory, which
+    can be decided without matching any pattern.
+
+    In the file, each directory comes with the patterns for its
+    ancestors, which git requires:
+
+        /*
+        !/*/
+        /src/
+        !/src/*/
+        /src/lib/"""
+
+    def __init__(self, recursive=()):
+        self.recursive = set()
+        self.parents = set([""])
+        for d in recursive:
+            self.add(d)
+
+    def add(self, d):
+        d = d.strip("/")
+        self.recursive.add(d)
+        parent = os.path.dirname(d)
+        while parent:
+            self.parents.add(parent)
+            parent = os.path.dirname(parent)
+
+    def dir_state(self, d):
+        """Return "in" if everything under directory d is included,
+        "parent" if only its files and some subdirectories are, and
+        "out" if nothing is."""
+        parent = d
+        while parent:
+            if parent in self.recursive:
+                return "in"
+            parent = os.path.dirname(parent)
+        return "parent" if d in self.parents else "out"
+
+    def includes(self, path):
+        """Whether file path is in the sparse checkout."""
+        return self.dir_state(os.path.dirname(path)) != "out"
+
+    def serialize(self):
+        lines = ["/*", "!/*/"]
+        for d in sorted(self.parents | self.recursive):
+            if d:
+                lines.append("/{0}/".format(d))
+                if d in self.parents and not d in self.recursive:
+                    lines.append("!/{0}/*/".format(d))
+        return "".join([line + "\n" for line in lines])
+
+def sparse_cone_parse(lines):
+    """Parse the cone-mode patterns lines, return a GitSparseCone."""
+    dirs = list()
+    parents = set()
+    for line in lines:
+        line = line.strip()
+        if line in ("/*", "!/*/") or not line or line.startswith("#"):
+            continue
+        if line.startswith("!/") and line.endswith("/*/"):
+            parents.add(line[2:-3])
+        elif line.startswith("/") and line.endswith("/"):
+            dirs.append(line[1:-1])
+        else:
+            raise Exception("Not a cone-mode sparse-checkout pattern: {0}".format(line))
+    return GitSparseCone([d for d in dirs if not d in parents])
+
+class GitLooseIndex(object):
+    """The names of the loose objects, as sorted lists per fanout
+    directory (objects/xx), built on first use.
+
+    A directory's list is reused as long as the directory's mtime
+    hasn't changed, which is the case as long as nobody added or
+    removed an object in it.  Our own writes are recorded with add(),
+    so they don't invalidate anything."""
+
+    def __init__(self, objects_dir):
+        self.objects_dir = objects_dir
+        # Fanout ("ab") -> (mtime_ns, sorted list of the 38 remaining
+        # hex digits of each object)
+        self.dirs = dict()
+        # Objects may be written from several threads.
+        self.lock = threading.Lock()
+
+    def names(self, fanout, fresh=True):
+        """Return the sorted list of objects under fanout.  If fresh is
+        False and we have a list, trust it without checking mtime."""
+        cached = self.dirs.get(fanout)
+        if cached and not fresh:
+            return cached[1]
+
+        path = os.path.join(self.objects_dir, fanout)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            self.dirs.pop(fanout, None)
+            return []
+
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        # Skip anything that isn't an object name (temporary files)
+        names = sorted(f for f in os.listdir(path) if len(f) == 38)
+        self.dirs[fanout] = (mtime, names)
+        return names
+
+    def find_prefix(self, prefix):
+        """Return the full hex names of the loose objects starting with
+        prefix, which must be at least two characters long."""
+        fanout = prefix[0:2]
+        rem = prefix[2:]
+        ret = list()
+        with self.lock:
+            names = self.names(fanout)
+            i = bisect.bisect_left(names, rem)
+            while i < len(names) and names[i].startswith(rem):
+                ret.append(fanout + names[i])
+                i += 1
+        return ret
+
+    def contains(self, sha, fresh=True):
+        with self.lock:
+            names = self.names(sha[0:2], fresh)
+            rem = sha[2:]
+            i = bisect.bisect_left(names, rem)
+            return i < len(names) and names[i] == rem
+
+    def add(self, sha):
+        """Record that we just wrote loose object sha."""
+        fanout = sha[0:2]
+        with self.lock:
+            cached = self.dirs.get(fanout)
+            if not cached:
+                return
+            names = cached[1]
+            rem = sha[2:]
+            i = bisect.bisect_left(names, rem)
+            if i == len(names) or names[i] != rem:
+                names.insert(i, rem)
+            # Our write changed the directory's mtime: take the new one,
+            # or the next lookup would list the directory again.
+            try:
+                self.dirs[fanout] = (os.stat(os.path.join(self.objects_dir, fanout)).st_mtime_ns, names)
+            except FileNotFoundError:
+                self.dirs.pop(fanout, None)
+
+def fsync_dir(path):
+    """fsync a directory, which makes the creation, rename or deletion
+    of its entries durable."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def syncfs(path):
+    """Flush everything written to the filesystem holding path.  On
+    Linux this is syncfs(2), a single call however many files we wrote;
+    elsewhere we fall back to sync(2)."""
+    try:
+        libc_syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        os.sync()
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if libc_syncfs(fd) != 0:
+            os.sync()
+    finally:
+        os.close(fd)
+
+class GitObjectBatch(object):
+    """Moves new loose objects from their temporary file to their final
+    path, according to core.fsyncMethod:
+
+     - "none" (the default): rename right away, never sync.  Objects
+       still can't be seen half-written, but may be lost in a crash.
+     - "fsync": fsync each object before renaming it, then its
+       directory.  Safe, but we wait for the disk once per object.
+     - "batch": don't sync or rename anything, until flush() syncs the
+       whole filesystem once, then renames every object into place,
+       then syncs once more.  An add or commit writing thousands of
+       objects waits for the disk twice.  Until then, pending objects
+       aren't visible to readers, but object_exists knows about them.
+
+    Callers must flush() before anything durable points to the new
+    objects: before writing the index or updating a ref."""
+
+    def __init__(self, method, objects_dir, loose):
+        if not method in ("none", "fsync", "batch"):
+            raise Exception("Unsupported core.fsyncMethod {0}".format(method))
+        self.method = method
+        self.objects_dir = objects_dir
+        self.loose = loose
+        # sha -> (temporary path, final path)
+        self.pending = dict()
+        self.lock = threading.Lock()
+
+    def place(self, sha, f, tmp_path, path):
+        """Finish the object sha written to file object f, open on
+        tmp_path, and move it to path (maybe later)."""
+        if self.method == "fsync":
+            f.flush()
+            os.fsync(f.fileno())
+        f.close()
+        # Objects are read-only, like git does.
+        os.chmod(tmp_path, 0o444)
+
+        if self.method == "batch":
+            with self.lock:
+                if sha in self.pending:
+                    os.unlink(tmp_path)
+                else:
+                    self.pending[sha] = (tmp_path, path)
+            return
+
+        os.replace(tmp_path, path)
+        if self.method == "fsync":
+            fsync_dir(os.path.dirname(path))
+        self.loose.add(sha)
+
+    def contains(self, sha):
+        return sha in self.pending
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            # First make the content of every object durable, in one go.
+            syncfs(self.objects_dir)
+            for sha, (tmp_path, path) in self.pending.items():
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+                self.loose.add(sha)
+            # Then the renames.
+            syncfs(self.objects_dir)
+            self.pending.clear()
+
 class GitRepository(object):
     """A git repository"""
 
     worktree = None
     gitdir = None
     conf = None
+    packs = None
+    loose = None
+    batch = None
+    cache = None
 
     def __init__(self, path, force=False):
         self.worktree = path
@@ -74,7 +920,7 @@ class GitRepository(object):
         if not os.path.exists(config_file):
             raise Exception("Config file missing %s" % config_file)
 
-        self.conf.read([config_file])
+        conf_read(self.conf, [config_file])
         vers = int(self.conf.get("core", "repositoryformatversion"))
         if vers != 0:
             raise Exception("Unsupported repositoryformatversion %s" % vers)
@@ -120,7 +966,9 @@ class GitRepository(object):
         
         if not os.path.exists(path):
             if mkdir:
-                os.makedirs(path)
+                # Someone else (another writer thread) may be creating
+                # it at the same time.
+                os.makedirs(path, exist_ok=True)
                 return path
             return None
             
@@ -129,6 +977,114 @@ class GitRepository(object):
         else:
             raise Exception("Not a directory %s" % path)
 
+    def conf_get_size(self, section, option, default):
+        """Read a size from the configuration, with git's optional k, m
+        or g suffix (eg, "96m").  Return default if it's not set."""
+        value = self.conf.get(section, option, fallback=None)
+        if value is None:
+            return default
+        value = value.strip().lower()
+        units = { "k": 1024, "m": 1024**2, "g": 1024**3 }
+        if value and value[-1] in units:
+            return int(value[:-1]) * units[value[-1]]
+        return int(value)
+
+    def pack_list(self):
+        """Return the packs of this repository, opening them on first use."""
+        if self.packs is None:
+            delta_cache = GitDeltaBaseCache(
+                self.conf_get_size("core", "deltaBaseCacheLimit", DELTA_BASE_CACHE_DEFAULT))
+            self.packs = pack_open_all(os.path.join(self.gitdir, "objects"), delta_cache)
+        return self.packs
+
+    def loose_index(self):
+        """Return the index of loose object names, creating it on first use."""
+        if self.loose is None:
+            self.loose = GitLooseIndex(os.path.join(self.gitdir, "objects"))
+        return self.loose
+
+    def conf_set(self, section, option, value):
+        """Set section.option to value in the repository's configuration,
+        and write it back."""
+        if not self.conf.has_section(section):
+            self.conf.add_section(section)
+        self.conf.set(section, option, value)
+        out = io.StringIO()
+        self.conf.write(out)
+        self.write_atomic("config", out.getvalue().encode("utf8"))
+
+    def sparse_cone(self):
+        """Return the GitSparseCone of the worktree, or None if it's not
+        a sparse checkout (core.sparseCheckout)."""
+        if not self.conf.getboolean("core", "sparseCheckout", fallback=False):
+            return None
+        path = os.path.join(self.gitdir, "info", "sparse-checkout")
+        if not os.path.exists(path):
+            return GitSparseCone()
+        with open(path, "r") as f:
+            return sparse_cone_parse(f.readlines())
+
+    def object_batch(self):
+        """Return the GitObjectBatch new loose objects go through."""
+        if self.batch is None:
+            self.batch = GitObjectBatch(self.conf.get("core", "fsyncMethod", fallback="none"),
+                                        os.path.join(self.gitdir, "objects"),
+                                        self.loose_index())
+        return self.batch
+
+    def write_atomic(self, path, data, if_able=False):
+        """Replace file path (relative to the gitdir) with data, going
+        through path.lock, like git.  Creating the lock fails if it
+        already exists, so two writers can't step on each other; and
+        readers see either the old content or the new one, never a
+        truncated file.  Unless core.fsyncMethod is "none", the new
+        content is synced before it replaces the old.
+
+        With if_able, the write is only opportunistic: if the lock is
+        taken, return False rather than raise."""
+        path = os.path.join(self.gitdir, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lock = path + ".lock"
+        try:
+            fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            if if_able:
+                return False
+            raise Exception("Unable to create {0}: is another wyag process running?".format(lock))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                if self.conf.get("core", "fsyncMethod", fallback="none") != "none":
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(lock, path)
+        except:
+            if os.path.exists(lock):
+                os.unlink(lock)
+            raise
+        return True
+
+    def object_cache(self):
+        """Return the cache of parsed objects, creating it on first use.
+        Its budget is core.objectCacheSize (32m by default), and blobs
+        over core.objectCacheBigBlob (1m) aren't cached.  Set
+        WYAG_TRACE_CACHE in the environment to get its statistics (and
+        the delta base cache's) on exit."""
+        if self.cache is None:
+            self.cache = GitObjectCache(
+                self.conf_get_size("core", "objectCacheSize", 32 * 1024**2),
+                self.conf_get_size("core", "objectCacheBigBlob", 1024**2))
+            if os.environ.get("WYAG_TRACE_CACHE"):
+                atexit.register(self.cache_trace)
+        return self.cache
+
+    def cache_trace(self):
+        self.cache.trace()
+        if self.packs:
+            c = self.packs[0].delta_cache
+            print("delta base cache: objects={}, bytes={}, max_bytes={}, hits={}, misses={}, evictions={}".format(
+                len(c.entries), c.bytes, c.max_bytes, c.hits, c.misses, c.evictions), file=sys.stderr)
+
     def rm_path(self, paths, delete=True, skip_missing=False):
          # Find and read the index
         index = self.read_index()
@@ -144,28 +1100,30 @@ class GitRepository(object):
             else:
                 raise Exception("Cannot remove paths outside of worktree: {}".format(paths))
 
-        kept_entries = list()
-        remove = list()
-
-        for e in index.entries:
-            full_path = os.path.join(self.worktree, e.name)
+        remove = dict()
+        missing = list()
 
-            if full_path in abspaths:
-                remove.append(full_path)
-                abspaths.remove(full_path)
+        for abspath in abspaths:
+            name = os.path.relpath(abspath, self.worktree)
+            positions = index.find_all(name)
+            if positions:
+                remove[abspath] = positions
+                index.invalidate_path(name)
             else:
-                kept_entries.append(e) # Preserve entry
+                missing.append(abspath)
 
-        if len(abspaths) > 0 and not skip_missing:
-            raise Exception("Cannot remove paths not in the index: {}".format(abspaths))
+        if len(missing) > 0 and not skip_missing:
+            raise Exception("Cannot remove paths not in the index: {}".format(missing))
 
         if delete:
             for path in remove:
                 os.unlink(path)
 
-        index.entries = kept_entries
-        write_index(repo, index)
-        
+        index.remove([i for positions in remove.values() for i in positions])
+        self.write_index(index)
+        return index
+
+
     def read_index(self) -> GitIndex:
         index_file = self.create_filerepo("index")
 
@@ -174,57 +1132,94 @@ class GitRepository(object):
             return GitIndex()
 
         with open(index_file, 'rb') as f:
+            timestamp = os.fstat(f.fileno()).st_mtime_ns
             raw = f.read()
 
+        # The last 20 bytes are the SHA-1 of everything before, or all
+        # zeros if git wrote it with index.skipHash: then there's
+        # nothing to check.
+        if raw[-20:] != bytes(20) and hashlib.sha1(memoryview(raw)[:-20]).digest() != raw[-20:]:
+            raise Exception("Bad index file checksum: {0}".format(index_file))
+
         header = raw[:12]
         signature = header[:4]
         assert signature == b"DIRC" # Stands for "DirCache"
         version = int.from_bytes(header[4:8], "big")
-        assert version == 2, "wyag only supports index file version 2"
+        assert version in (2, 3, 4), "wyag only supports index file versions 2 to 4"
         count = int.from_bytes(header[8:12], "big")
 
-        entries = list()
-
-        content = raw[12:]
-        idx = 0
-        for i in range(0, count):
-            # Read creation time, as a unix timestamp (seconds since
-            # 1970-01-01 00:00:00, the "epoch")
-            ctime_s =  int.from_bytes(content[idx: idx+4], "big")
-            # Read creation time, as nanoseconds after that timestamps,
-            # for extra precision.
-            ctime_ns = int.from_bytes(content[idx+4: idx+8], "big")
-            # Same for modification time: first seconds from epoch.
-            mtime_s = int.from_bytes(content[idx+8: idx+12], "big")
-            # Then extra nanoseconds
-            mtime_ns = int.from_bytes(content[idx+12: idx+16], "big")
-            # Device ID
-            dev = int.from_bytes(content[idx+16: idx+20], "big")
-            # Inode
-            ino = int.from_bytes(content[idx+20: idx+24], "big")
-            # Ignored.
-            unused = int.from_bytes(content[idx+24: idx+26], "big")
-            assert 0 == unused
-            mode = int.from_bytes(content[idx+26: idx+28], "big")
-            mode_type = mode >> 12
-            assert mode_type in [0b1000, 0b1010, 0b1110]
-            mode_perms = mode & 0b0000000111111111
-            # User ID
-            uid = int.from_bytes(content[idx+28: idx+32], "big")
-            # Group ID
-            gid = int.from_bytes(content[idx+32: idx+36], "big")
-            # Size
-            fsize = int.from_bytes(content[idx+36: idx+40], "big")
-            # SHA (object ID).  We'll store it as a lowercase hex string
-            # for consistency.
-            sha = format(int.from_bytes(content[idx+40: idx+60], "big"), "040x")
-            # Flags we're going to ignore
-            flags = int.from_bytes(content[idx+60: idx+62], "big")
+        index = GitIndex(version=version)
+        index.timestamp = timestamp
+        idx = self.index_parse_entries(index, memoryview(raw), 12, count)
+
+        # EXTENSIONS: each starts with a 4 bytes signature and the size
+        # of its data, on 4 bytes.
+        while idx < len(raw) - 20:
+            signature = raw[idx:idx+4]
+            size = int.from_bytes(raw[idx+4:idx+8], "big")
+            data = memoryview(raw)[idx+8:idx+8+size]
+            if signature == b"TREE":
+                index.cache_tree = cache_tree_parse(bytes(data))
+            elif signature == b"UNTR":
+                index.untracked_cache = untracked_cache_parse(bytes(data))
+            elif signature == b"sdir":
+                # Marks a sparse index: some entries are directories.
+                # Nothing to do, we always know how to read those.
+                pass
+            elif signature == b"FSMN":
+                # Version 2: the token, then the bitmap of dirty
+                # entries, preceded by its size.
+                data = bytes(data)
+                fsmn_version, = struct.unpack_from(">I", data, 0)
+                if fsmn_version == 2:
+                    nul = data.find(b"\x00", 4)
+                    index.fsmonitor_token = data[4:nul].decode("utf8")
+                    dirty, _ = ewah_parse(data, nul + 1 + 4)
+                    index.fsmonitor_dirty = set([index.names[i] for i in dirty])
+            elif not b"A" <= signature[:1] <= b"Z":
+                # Extensions starting with an uppercase letter are
+                # optional, we can ignore those we don't know.
+                raise Exception("Unsupported index extension {0}".format(signature))
+            idx += 8 + size
+
+        return index
+  
+    def index_parse_entries(self, index, raw, idx, count):
+        """Parse count entries of raw, starting at offset idx, into the
+        columns of index.  Return the offset following the last entry.
+
+        Each entry is made of:
+
+          - 62 bytes of fixed-size fields: creation time and
+            modification time (seconds since the epoch, and extra
+            nanoseconds), device ID, inode, 16 unused bits, mode, user
+            ID, group ID, size (all on 32 bits, except the mode on 16),
+            the SHA (20 bytes) and 16 bits of flags;
+          - the name, NUL-terminated;
+          - padding, so the next entry starts on a multiple of eight
+            bytes.
+
+        Only the length of the name is variable, and it's stored in the
+        flags.  So we do a single pass to find where each entry starts
+        and read its flags and name, and we leave the rest for later.
+        (Since version 3, 16 bits of extended flags may follow the
+        flags.  In version 4, names are prefix-compressed, and entries
+        aren't padded.)
+        Then, the ten 32 bits integers at the start of each entry are
+        glued together and converted by a single array.frombytes: the
+        columns are just strided slices of that.  No Python object is
+        created per field, or per entry."""
+        unpack_flags = struct.Struct(">H").unpack_from
+        # Version 4 compresses each name against the previous one.
+        v4 = index.version == 4
+        prev = b""
+        offsets = list()
+        flags_col = list()
+        names = list()
+        for i in range(count):
+            flags, = unpack_flags(raw, idx + 60)
             # Parse flags
-            flag_assume_valid = (flags & 0b1000000000000000) != 0
             flag_extended = (flags & 0b0100000000000000) != 0
-            assert not flag_extended
-            flag_stage =  flags & 0b0011000000000000
             # Length of the name.  This is stored on 12 bits, some max
             # value is 0xFFF, 4095.  Since names can occasionally go
             # beyond that length, git treats 0xFFF as meaning at least
@@ -232,49 +1227,211 @@ class GitRepository(object):
             # name --- at a small, and probably very rare, performance
             # cost.
             name_length = flags & 0b0000111111111111
+            start = idx + 62
+            offsets.append(idx)
+            # We keep the assume-valid and stage bits.
+            flags &= 0b1011000000000000
+            if flag_extended:
+                # Since version 3, 16 more bits of flags may follow.
+                assert index.version >= 3
+                flags |= unpack_flags(raw, start)[0] << 16
+                start += 2
+            flags_col.append(flags)
 
-            # We've read 62 bytes so far.
-            idx += 62
+            if v4:
+                # The name starts with the number of bytes to remove
+                # from the end of the previous name, as a varint (the
+                # same encoding as OFS_DELTA offsets in packs), followed
+                # by the bytes to append to what's left.
+                c = raw[start]
+                start += 1
+                strip = c & 0x7f
+                while c & 0x80:
+                    c = raw[start]
+                    start += 1
+                    strip = ((strip + 1) << 7) | (c & 0x7f)
+                prefix = prev[:len(prev) - strip]
+                if name_length < 0xFFF:
+                    end = start + name_length - len(prefix)
+                    assert raw[end] == 0x00
+                else:
+                    end = raw.obj.find(b'\x00', start)
+                prev = prefix + raw[start:end]
+                # Just parse the name as utf8.
+                names.append(prev.decode("utf8"))
+                # No padding in version 4.
+                idx = end + 1
+                continue
 
             if name_length < 0xFFF:
-                assert content[idx + name_length] == 0x00
-                raw_name = content[idx:idx+name_length]
-                idx += name_length + 1
+                end = start + name_length
+                assert raw[end] == 0x00
             else:
-                print("Notice: Name is 0x{:X} bytes long.".format(name_length))
-                # This probably wasn't tested enough.  It works with a
-                # path of exactly 0xFFF bytes.  Any extra bytes broke
-                # something between git, my shell and my filesystem.
-                null_idx = content.find(b'\x00', idx + 0xFFF)
-                raw_name = content[idx: null_idx]
-                idx = null_idx + 1
-
+                end = raw.obj.find(b'\x00', start + 0xFFF)
             # Just parse the name as utf8.
-            name = raw_name.decode("utf8")
-
+            names.append(str(raw[start:end], "utf8"))
             # Data is padded on multiples of eight bytes for pointer
             # alignment, so we skip as many bytes as we need for the next
             # read to start at the right position.
+            idx += (end - idx + 8) & ~7
+
+        fixed = array("I")
+        fixed.frombytes(b"".join([raw[o:o+40] for o in offsets]))
+        if sys.byteorder == "little":
+            fixed.byteswap()
+
+        index.ctime_s = fixed[0::10]
+        index.ctime_ns = fixed[1::10]
+        index.mtime_s = fixed[2::10]
+        index.mtime_ns = fixed[3::10]
+        index.dev = fixed[4::10]
+        index.ino = fixed[5::10]
+        # The 16 unused bits and the 16 bits of the mode, read together:
+        # if the unused bits aren't zero, the type check fails.
+        index.mode = fixed[6::10]
+        index.uid = fixed[7::10]
+        index.gid = fixed[8::10]
+        index.fsize = fixed[9::10]
+        index.shas = bytearray(b"".join([raw[o+40:o+60] for o in offsets]))
+        index.flags = array("I", flags_col)
+        index.names = names
+
+        for mode in set(index.mode):
+            assert mode >> 12 in [0b1000, 0b1010, 0b1110, 0b0100], "Bad mode {0:o} in index".format(mode)
+
+        return idx
+
+    def write_index(self, index, if_able=False):
+        """Serialize index and write it to .git/index.
+
+        The whole file is built in a single bytearray, allocated at its
+        final size: entries are copied into it field by field, and the
+        NUL after each name and the padding are already there, since the
+        buffer starts zeroed.  It ends with the SHA-1 of everything
+        before, which git checks.  The file is then written in one go
+        through index.lock, and renamed over the index (see
+        write_atomic): a crash or another wyag process never leaves a
+        half-written index.  See write_atomic for if_able."""
+        count = len(index)
+        index.smudge_racy()
+
+        # The ten 32 bits integers at the start of each entry (the 16
+        # unused bits and the 16 bits of the mode make one), interleaved
+        # back from the columns, in network byte order.  This is the
+        # reverse of index_parse_entries.
+        fixed = array("I", bytes(40 * count))
+        fixed[0::10] = index.ctime_s
+        fixed[1::10] = index.ctime_ns
+        fixed[2::10] = index.mtime_s
+        fixed[3::10] = index.mtime_ns
+        fixed[4::10] = index.dev
+        fixed[5::10] = index.ino
+        fixed[6::10] = index.mode
+        fixed[7::10] = index.uid
+        fixed[8::10] = index.gid
+        fixed[9::10] = index.fsize
+        if sys.byteorder == "little":
+            fixed.byteswap()
+        fixed = memoryview(fixed.tobytes())
+        shas = memoryview(index.shas)
+
+        # index.version in the configuration picks the format; by
+        # default, we keep the one we read.
+        version = self.conf.getint("index", "version", fallback=index.version)
+        if not version in (2, 3, 4):
+            raise Exception("Unsupported index.version {0}".format(version))
+        # Extended flags need version 3.
+        extended = any([f >> 16 for f in index.flags])
+        if extended and version == 2:
+            version = 3
+
+        names = [name.encode("utf8") for name in index.names]
+        flags = index.flags
+        # Git wants entries sorted by name (as bytes), then stage.
+        order = index.order()
+
+        # What follows the flags in each entry: the extended flags, if
+        # any, then in version 2 and 3 the name, a NUL, and padding to a
+        # multiple of eight bytes.  In version 4, the number of bytes to
+        # remove from the end of the previous name and the bytes to
+        # append to what's left, then a NUL.  Paths in a sorted index
+        # share long prefixes, so this is most of the file on deep
+        # trees.
+        tails = list()
+        size = 12
+        if version == 4:
+            prev = b""
+            for i in order:
+                name = names[i]
+                ext = flags[i] >> 16
+                # Length of the common prefix: XOR both names as big
+                # integers, the leading zero bits are the equal ones.
+                n = min(len(prev), len(name))
+                diff = int.from_bytes(prev[:n], "big") ^ int.from_bytes(name[:n], "big")
+                common = (8 * n - diff.bit_length()) // 8
+                tail = pack_ofs_encode(len(prev) - common) + name[common:]
+                if ext:
+                    tail = ext.to_bytes(2, "big") + tail
+                tails.append(tail)
+                size += 62 + len(tail) + 1
+                prev = name
+        else:
+            for i in order:
+                tail = names[i]
+                ext = flags[i] >> 16
+                if ext:
+                    tail = ext.to_bytes(2, "big") + tail
+                tails.append(tail)
+                size += (62 + len(tail) + 8) & ~7
+
+        # EXTENSIONS, after the entries.
+        extensions = bytearray()
+        if index.cache_tree is not None:
+            data = index.cache_tree.serialize(bytearray())
+            extensions += b"TREE" + len(data).to_bytes(4, "big") + data
+        if index.untracked_cache is not None:
+            data = index.untracked_cache.serialize(bytearray())
+            extensions += b"UNTR" + len(data).to_bytes(4, "big") + data
+        if INDEX_SPARSE_DIR_MODE in index.mode:
+            # git only accepts directory entries in a sparse index.
+            extensions += b"sdir" + bytes(4)
+        if index.fsmonitor_token is not None:
+            dirty = [pos for (pos, i) in enumerate(order) if index.names[i] in index.fsmonitor_dirty]
+            bitmap = ewah_serialize(dirty, count, bytearray())
+            data = (struct.pack(">I", 2) + index.fsmonitor_token.encode("utf8") + b"\x00"
+                    + struct.pack(">I", len(bitmap)) + bitmap)
+            extensions += b"FSMN" + len(data).to_bytes(4, "big") + data
+        entries_end = size
+        size += len(extensions)
+
+        buf = bytearray(size + 20)
+        buf[entries_end:size] = extensions
+
+        # HEADER: magic bytes, version number, number of entries.
+        struct.pack_into(">4sII", buf, 0, b"DIRC", version, count)
+
+        # ENTRIES
+        pack_flags = struct.Struct(">H").pack_into
+        idx = 12
+        for i, tail in zip(order, tails):
+            buf[idx:idx+40] = fixed[40*i:40*i+40]
+            buf[idx+40:idx+60] = shas[20*i:20*i+20]
+            # We merge back three pieces of data (two flags and the
+            # length of the name) on the same two bytes, plus a bit
+            # saying if extended flags follow.  Names longer than 0xFFF
+            # bytes get 0xFFF, see index_parse_entries.
+            pack_flags(buf, idx + 60, (flags[i] & 0xFFFF) | (0x4000 if flags[i] >> 16 else 0)
+                       | min(len(names[i]), 0xFFF))
+            buf[idx+62:idx+62+len(tail)] = tail
+            if version == 4:
+                idx += 62 + len(tail) + 1
+            else:
+                idx += (62 + len(tail) + 8) & ~7
+
+        buf[size:] = hashlib.sha1(memoryview(buf)[:size]).digest()
+
+        return self.write_atomic("index", buf, if_able)
 
-            idx = 8 * ceil(idx / 8)
-
-            # And we add this entry to our list.
-            entries.append(GitIndexEntry(ctime=(ctime_s, ctime_ns),
-                                        mtime=(mtime_s,  mtime_ns),
-                                        dev=dev,
-                                        ino=ino,
-                                        mode_type=mode_type,
-                                        mode_perms=mode_perms,
-                                        uid=uid,
-                                        gid=gid,
-                                        fsize=fsize,
-                                        sha=sha,
-                                        flag_assume_valid=flag_assume_valid,
-                                        flag_stage=flag_stage,
-                                        name=name))
-
-        return GitIndex(version=version, entries=entries)
-  
 class GitIgnore(object):
     absolute = None
     scoped = None
@@ -284,6 +1441,15 @@ class GitIgnore(object):
         self.scoped = scoped
 
 
+def conf_read(conf, paths):
+    """Read the git configuration files paths into ConfigParser conf.
+    git indents keys with a tab, which ConfigParser would take for the
+    continuation of the previous value: we remove indentation first."""
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                conf.read_string("".join([line.lstrip() for line in f]), path)
+
 def find_git_repo(path=".") -> GitRepository:
     path = os.path.realpath(path)
     if os.path.isdir(os.path.join(path, ".git")):
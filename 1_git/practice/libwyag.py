@@ -18,6 +18,7 @@
 
 import argparse
 import collections
+import concurrent.futures
 import configparser
 from datetime import datetime
 import grp, pwd
@@ -26,10 +27,16 @@ import hashlib
 from math import ceil
 import os
 import re
+from stat import S_ISDIR, S_ISLNK, S_ISREG
 import sys
+import tempfile
+import time
 import zlib
-from libgitrepo import GitRepository, GitIgnore, GitIndex, GitIndexEntry, find_git_repo
-from libgitobj import GitBlob, GitCommit, GitTree, GitTreeLeaf, GitTag
+from libgitrepo import GitRepository, GitIgnore, GitIndex, GitIndexEntry, GitCacheTree, GitSparseCone, GitUntrackedCache, GitUntrackedDir, stat_data, conf_read, find_git_repo
+from libgitrepo import INDEX_SKIP_WORKTREE, INDEX_SPARSE_DIR_MODE
+from libgitobj import GitBlob, GitCommit, GitTree, GitTreeLeaf, GitTag, GitObjectWriter
+from libgitmonitor import GitMonitor, MONITOR_SOCKET, monitor_query, monitor_request
+from libgitpack import PACK_FMT_TYPE, pack_compress_segment, pack_write
 argparser = argparse.ArgumentParser(description="The stupidest content tracker")
 argsubparsers = argparser.add_subparsers(title="Commands", dest="command")
 argsubparsers.required = True
@@ -44,15 +51,20 @@ def main(argv=sys.argv[1:]):
         case "check-ignore" : cmd_check_ignore(args)
         case "checkout"     : cmd_checkout(args)
         case "commit"       : cmd_commit(args)
+        case "gc"           : cmd_gc(args)
         case "hash-object"  : cmd_hash_object(args)
         case "log"          : cmd_log(args)
         case "ls-files"     : cmd_ls_files(args)
         case "ls-tree"      : cmd_ls_tree(args)
+        case "monitor"      : cmd_monitor(args)
+        case "repack"       : cmd_repack(args)
         case "rev-parse"    : cmd_rev_parse(args)
         case "rm"           : cmd_rm(args)
         case "show-ref"     : cmd_show_ref(args)
+        case "sparse-checkout" : cmd_sparse_checkout(args)
         case "status"       : cmd_status(args)
         case "tag"          : cmd_tag(args)
+        case "update-index" : cmd_update_index(args)
         case _              : print("=========Bad command.")
 
 
@@ -73,15 +85,46 @@ def cmd_init(args) -> GitRepository:
 
 def object_read(repo, sha):
     """Read object sha from Git repository repo.  Return a
-    GitObject whose exact type depends on the object."""
+    GitObject whose exact type depends on the object.
 
-    path = repo.create_filerepo("objects", sha[0:2], sha[2:])
+    Objects are cached, so the same instance may be returned to
+    different callers: don't modify it."""
 
-    if not os.path.isfile(path):
+    cache = repo.object_cache()
+    obj = cache.get(sha)
+    if obj is not None:
+        return obj
+
+    raw = object_read_raw(repo, sha)
+    if raw is None:
         return None
+    fmt, data = raw
+
+    # Pick constructor
+    match fmt:
+        case b'commit' : c=GitCommit
+        case b'tree'   : c=GitTree
+        case b'tag'    : c=GitTag
+        case b'blob'   : c=GitBlob
+        case _:
+            raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
+
+    # Call constructor, and remember the object for next time.
+    obj = c(data)
+    cache.put(sha, obj, len(data))
+    return obj
+
+def object_read_raw(repo, sha):
+    """Read object sha from Git repository repo, without parsing it.
+    Return a pair (fmt, data), or None if the object doesn't exist.
+    Loose objects are looked up first, then packs."""
+
+    path = repo.create_filerepo("objects", sha[0:2], sha[2:])
 
-    with open (path, "rb") as f:
-        raw = zlib.decompress(f.read())
+    # path is None if the fanout directory doesn't even exist.
+    if path and os.path.isfile(path):
+        with open (path, "rb") as f:
+            raw = zlib.decompress(f.read())
 
         # Read object type
         x = raw.find(b' ')
@@ -93,19 +136,113 @@ def object_read(repo, sha):
         if size != len(raw)-y-1:
             raise Exception("Malformed object {0}: bad length".format(sha))
 
-        # Pick constructor
-        match fmt:
-            case b'commit' : c=GitCommit
-            case b'tree'   : c=GitTree
-            case b'tag'    : c=GitTag
-            case b'blob'   : c=GitBlob
-            case _:
-                raise Exception("Unknown type {0} for object {1}".format(fmt.decode("ascii"), sha))
+        return fmt, raw[y+1:]
+
+    # Not a loose object: maybe it's been packed.
+    binsha = bytes.fromhex(sha)
+    for pack in repo.pack_list():
+        ret = pack.read(binsha)
+        if ret:
+            return ret
+
+    return None
+
+def object_info(repo, sha):
+    """Return a pair (fmt, size) for object sha, or None if it doesn't
+    exist.  This only inflates the header of a loose object, or reads
+    the entry header of a packed one: it's much cheaper than object_read
+    when all we want is the type."""
 
-        # Call constructor and return object
-        return c(raw[y+1:])
+    ret = repo.object_cache().info(sha)
+    if ret:
+        return ret
+
+    path = repo.create_filerepo("objects", sha[0:2], sha[2:])
+
+    if path and os.path.isfile(path):
+        with open(path, "rb") as f:
+            # The header is "<type> <size>\x00", so a few dozen bytes
+            # are enough.  We feed the decompressor small chunks, and
+            # ask it for small outputs, until we've seen the NUL.
+            d = zlib.decompressobj()
+            header = b''
+            while not b'\x00' in header:
+                if d.unconsumed_tail:
+                    data = d.unconsumed_tail
+                else:
+                    data = f.read(64)
+                    if not data:
+                        raise Exception("Malformed object {0}: truncated header".format(sha))
+                header += d.decompress(data, 32)
+
+        x = header.find(b' ')
+        y = header.find(b'\x00', x)
+        return header[0:x], int(header[x:y].decode("ascii"))
+
+    binsha = bytes.fromhex(sha)
+    for pack in repo.pack_list():
+        ret = pack.info(binsha)
+        if ret:
+            return ret
+
+    return None
+
+# Blobs are hashed, compressed and inflated by chunks of this size, so
+# large files never need to fit in memory.
+STREAM_CHUNK = 1024 * 1024
+
+def object_stream(repo, sha):
+    """Like object_read_raw, but return (fmt, size, chunks), where
+    chunks iterates over the object's content: only a chunk at a time
+    is held in memory.  Return None if the object doesn't exist."""
+
+    path = repo.create_filerepo("objects", sha[0:2], sha[2:])
+
+    if path and os.path.isfile(path):
+        f = open(path, "rb")
+        d = zlib.decompressobj()
+
+        # Inflate until we have the whole header.
+        head = b''
+        while not b'\x00' in head:
+            data = d.unconsumed_tail or f.read(STREAM_CHUNK)
+            if not data:
+                f.close()
+                raise Exception("Malformed object {0}: truncated header".format(sha))
+            head += d.decompress(data, STREAM_CHUNK)
+
+        x = head.find(b' ')
+        y = head.find(b'\x00', x)
+        size = int(head[x:y].decode("ascii"))
+        return head[0:x], size, object_stream_chunks(sha, f, d, head[y+1:], size)
+
+    binsha = bytes.fromhex(sha)
+    for pack in repo.pack_list():
+        ret = pack.stream(binsha, STREAM_CHUNK)
+        if ret:
+            return ret
+
+    return None
 
-def object_write(obj, repo=None):
+def object_stream_chunks(sha, f, d, first, size):
+    """Yield the rest of a loose object: first is what we inflated past
+    the header, then we go on with decompressor d over file f."""
+    with f:
+        total = len(first)
+        if first:
+            yield first
+        while not d.eof:
+            data = d.unconsumed_tail or f.read(STREAM_CHUNK)
+            if not data:
+                break
+            out = d.decompress(data, STREAM_CHUNK)
+            total += len(out)
+            if out:
+                yield out
+    if total != size:
+        raise Exception("Malformed object {0}: bad length".format(sha))
+
+def object_write(obj, repo=None, writer=None):
     # Serialize object data
     data = obj.serialize()
     # Add header
@@ -113,36 +250,190 @@ def object_write(obj, repo=None):
     # Compute hash
     sha = hashlib.sha1(result).hexdigest()
 
-    if repo:
-        # Compute path
-        path=repo.create_filerepo("objects", sha[0:2], sha[2:], mkdir=True)
-
-        if not os.path.exists(path):
-            with open(path, 'wb') as f:
-                # Compress and write
-                f.write(zlib.compress(result))
+    if repo and not object_exists(repo, sha, fresh=False):
+        if writer:
+            # We know the SHA already, which is all the caller needs:
+            # compression and writing can happen in the background.
+            writer.submit_once(sha, object_write_raw, repo, sha, result)
+        else:
+            object_write_raw(repo, sha, result)
     return sha
 
+def object_write_raw(repo, sha, result):
+    """Compress and write result, the full serialization of object sha
+    (header included), as a loose object.  It's written to a temporary
+    file first, which the repository's object batch moves into place:
+    no reader ever sees a truncated object."""
+    # Compute path
+    path=repo.create_filerepo("objects", sha[0:2], sha[2:], mkdir=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix="tmp_obj_")
+    f = os.fdopen(fd, 'wb')
+    try:
+        # Compress and write
+        f.write(zlib.compress(result))
+        repo.object_batch().place(sha, f, tmp_path, path)
+    except:
+        f.close()
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+def object_writer_open(repo):
+    """Return a GitObjectWriter for repo, with core.writeThreads workers
+    (one per CPU by default)."""
+    # Open packs, and create the loose object index and the object
+    # batch, now: object_exists and object_write_raw will be called
+    # from the workers, and we don't want them to race to do it (with
+    # core.fsyncMethod=batch, objects pending in a batch another worker
+    # replaced would never be moved into place).
+    repo.pack_list()
+    repo.loose_index()
+    repo.object_batch()
+    jobs = int(repo.conf.get("core", "writeThreads", fallback=0)) or os.cpu_count() or 1
+    return GitObjectWriter(jobs)
+
+def object_exists(repo, sha, fresh=True):
+    """Whether object sha is in the repository, loose or packed.
+
+    With fresh=False, an object written by another process since we
+    first looked may be missed.  That's fine for writers, who'd only
+    write the same object again."""
+    if repo.loose_index().contains(sha, fresh):
+        return True
+    # Written, but not moved into place yet.
+    if repo.object_batch().contains(sha):
+        return True
+    binsha = bytes.fromhex(sha)
+    for pack in repo.pack_list():
+        if pack.find(binsha) is not None:
+            return True
+    return False
+
+def object_resolve_prefix(repo, prefix):
+    """Return the full SHAs of all objects, loose or packed, whose name
+    starts with prefix, an hex string of at least two characters.  The
+    same object can be both loose and packed: we don't count it twice."""
+    candidates = repo.loose_index().find_prefix(prefix)
+    for pack in repo.pack_list():
+        for sha in pack.find_prefix(prefix):
+            if not sha in candidates:
+                candidates.append(sha)
+    return candidates
+
 
 
 argsp = argsubparsers.add_parser("cat-file",
                                  help="Provide content of repository objects")
 
+argsp.add_argument("-t",
+                   dest="show_type",
+                   action="store_true",
+                   help="Show the object's type instead of its content")
+
+argsp.add_argument("-s",
+                   dest="show_size",
+                   action="store_true",
+                   help="Show the object's size instead of its content")
+
+argsp.add_argument("--batch",
+                   dest="batch",
+                   action="store_true",
+                   help="Read object names from stdin, print their type, size and content")
+
+argsp.add_argument("--batch-check",
+                   dest="batch_check",
+                   action="store_true",
+                   help="Read object names from stdin, print their type and size")
+
+argsp.add_argument("--buffer",
+                   dest="buffer",
+                   action="store_true",
+                   help="With --batch or --batch-check, don't flush after each object")
+
 argsp.add_argument("type",
                    metavar="type",
-                   choices=["blob", "commit", "tag", "tree"],
-                   help="Specify the type")
+                   nargs="?",
+                   help="Specify the type (blob, commit, tag or tree)")
 
 argsp.add_argument("object",
                    metavar="object",
+                   nargs="?",
                    help="The object to display")
 
 def cmd_cat_file(args):
     repo = find_git_repo()
+
+    if args.batch or args.batch_check:
+        cat_file_batch(repo, sys.stdin, sys.stdout.buffer,
+                       contents=args.batch, flush=not args.buffer)
+        return
+
+    # With -t or -s, there's no type: the only positional argument is
+    # the object.
+    if args.show_type or args.show_size:
+        if args.object or not args.type:
+            raise Exception("Usage: cat-file (-t | -s) <object>")
+        cat_file_info(repo, args.type, show_size=args.show_size)
+        return
+
+    if not args.type in ["blob", "commit", "tag", "tree"] or not args.object:
+        raise Exception("Usage: cat-file <type> <object>")
     cat_file(repo, args.object, fmt=args.type.encode())
 
+def cat_file_batch(repo, input, output, contents=True, flush=True):
+    """Serve cat-file requests for every object name read from input,
+    one per line, until end of file.  For each, write "<sha> <type>
+    <size>" to output, followed by the content and a newline if
+    contents is True; or "<name> missing" (or ambiguous).
+
+    This is meant for tools that would otherwise run cat-file once per
+    object: we only pay once for starting up and finding the repository,
+    and the object caches and pack maps stay warm from one object to
+    the next.  Unless flush is False, output is flushed after each
+    object so the caller can read the answer before sending the next
+    name."""
+    while True:
+        line = input.readline()
+        if not line:
+            break
+        name = line.rstrip("\n")
+
+        # HEAD resolves to [None] on a repository without commits.
+        candidates = [ c for c in object_resolve(repo, name) if c ] if name.strip() else None
+        info = object_info(repo, candidates[0]) if candidates and len(candidates) == 1 else None
+
+        if not info:
+            status = "ambiguous" if candidates and len(candidates) > 1 else "missing"
+            output.write("{0} {1}\n".format(name, status).encode("utf8"))
+        else:
+            sha = candidates[0]
+            fmt, size = info
+            output.write("{0} {1} {2}\n".format(sha, fmt.decode("ascii"), size).encode("ascii"))
+            if contents:
+                _, _, chunks = object_stream(repo, sha)
+                for chunk in chunks:
+                    output.write(chunk)
+                output.write(b'\n')
+
+        if flush:
+            output.flush()
+
+    output.flush()
+
+def cat_file_info(repo, obj, show_size=False):
+    fmt, size = object_info(repo, object_find(repo, obj))
+    print(size if show_size else fmt.decode("ascii"))
+
 def cat_file(repo, obj, fmt=None):
-    obj = object_read(repo, object_find(repo, obj, fmt=fmt))
+    sha = object_find(repo, obj, fmt=fmt)
+    if fmt == b'blob':
+        # Blobs are copied as they're inflated, whatever their size.
+        _, _, chunks = object_stream(repo, sha)
+        for chunk in chunks:
+            sys.stdout.buffer.write(chunk)
+        return
+    obj = object_read(repo, sha)
     sys.stdout.buffer.write(obj.serialize())
 
 argsp = argsubparsers.add_parser(
@@ -162,6 +453,7 @@ argsp.add_argument("-w",
                    help="Actually write the object into the database")
 
 argsp.add_argument("path",
+                   nargs="+",
                    help="Read object from <file>")
 
 def cmd_hash_object(args):
@@ -170,12 +462,29 @@ def cmd_hash_object(args):
     else:
         repo = None
 
-    with open(args.path, "rb") as fd:
-        sha = object_hash(fd, args.type.encode(), repo)
-        print(sha)
+    if args.type == "blob" and len(args.path) > 1:
+        # Many blobs: hash them concurrently, print in order.
+        for (sha, _) in object_hash_paths(repo, args.path):
+            print(sha)
+        if repo:
+            repo.object_batch().flush()
+        return
+
+    for path in args.path:
+        with open(path, "rb") as fd:
+            sha = object_hash(fd, args.type.encode(), repo)
+            print(sha)
+
+    if repo:
+        repo.object_batch().flush()
 
 def object_hash(fd, fmt, repo=None):
     """ Hash object, writing it to repo if provided."""
+    if fmt == b'blob':
+        # Blobs are opaque: no need to parse them, so no need to load
+        # them in memory either.
+        return object_hash_stream(fd, repo)
+
     data = fd.read()
 
     # Choose constructor according to fmt argument
@@ -192,6 +501,81 @@ def object_hash(fd, fmt, repo=None):
 
 
 
+def object_hash_stream(fd, repo=None):
+    """Hash the content of file fd as a blob, writing it to repo if
+    provided.  The file is read by chunks, each hashed then compressed
+    to a temporary file in the object store, renamed into place once
+    complete: memory use doesn't depend on the file size."""
+    size = os.fstat(fd.fileno()).st_size
+    header = b'blob ' + str(size).encode() + b'\x00'
+
+    sha = hashlib.sha1(header)
+
+    if repo:
+        objects = repo.create_repo("objects", mkdir=True)
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=objects, prefix="tmp_obj_")
+        out = os.fdopen(tmp_fd, "wb")
+        compressor = zlib.compressobj()
+        out.write(compressor.compress(header))
+
+    try:
+        total = 0
+        while True:
+            chunk = fd.read(STREAM_CHUNK)
+            if not chunk:
+                break
+            total += len(chunk)
+            sha.update(chunk)
+            if repo:
+                out.write(compressor.compress(chunk))
+
+        if total != size:
+            raise Exception("File changed while being hashed: {0}".format(fd.name))
+
+        sha = sha.hexdigest()
+
+        if repo:
+            out.write(compressor.flush())
+            if object_exists(repo, sha, fresh=False):
+                out.close()
+                os.unlink(tmp_path)
+            else:
+                path = repo.create_filerepo("objects", sha[0:2], sha[2:], mkdir=True)
+                repo.object_batch().place(sha, out, tmp_path, path)
+    except:
+        if repo:
+            out.close()
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        raise
+
+    return sha
+
+def object_hash_path(path, repo=None, follow=True):
+    """Hash file path as a blob, writing it to repo if provided.
+    Return (sha, stat), where stat is the file's, taken as we opened
+    it.  With follow=False, a symlink isn't followed: like git stores
+    it, its blob is the path it points to, and stat is its lstat."""
+    if not follow:
+        stat = os.lstat(path)
+        if S_ISLNK(stat.st_mode):
+            return object_write(GitBlob(os.fsencode(os.readlink(path))), repo), stat
+    with open(path, "rb") as fd:
+        stat = os.fstat(fd.fileno())
+        return object_hash_stream(fd, repo), stat
+
+def object_hash_paths(repo, paths, follow=True):
+    """Hash files paths as blobs, concurrently, writing them to repo if
+    provided.  Return a list of (sha, stat), in the order of paths.  See
+    object_hash_path for follow."""
+    if repo is None or len(paths) < 2:
+        return [ object_hash_path(path, repo, follow) for path in paths ]
+
+    writer = object_writer_open(repo)
+    futures = [ writer.submit(object_hash_path, path, repo, follow) for path in paths ]
+    writer.close()
+    return [ f.result() for f in futures ]
+
 argsp = argsubparsers.add_parser("log", help="Display history of a given commit.")
 argsp.add_argument("commit",
                    default="HEAD",
@@ -260,9 +644,13 @@ def cmd_ls_tree(args):
     ls_tree(repo, args.tree, args.recursive)
 
 def ls_tree(repo, ref, recursive=None, prefix=""):
-    sha = object_find(repo, ref, fmt=b"tree")
+    ls_tree_sha(repo, object_find(repo, ref, fmt=b"tree"), recursive, prefix)
+
+def ls_tree_sha(repo, sha, recursive=None, prefix=""):
+    # Subtrees are already full SHAs of trees: no need to go through
+    # object_find again when we recurse.
     obj = object_read(repo, sha)
-    for item in obj.items:
+    for item in obj.tree_iter():
         if len(item.mode) == 5:
             type = item.mode[0:1]
         else:
@@ -284,7 +672,7 @@ def ls_tree(repo, ref, recursive=None, prefix=""):
                 item.sha,
                 os.path.join(prefix, item.path)))
         else: # This is a branch, recurse
-            ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
+            ls_tree_sha(repo, item.sha, recursive, os.path.join(prefix, item.path))
 
 argsp = argsubparsers.add_parser("checkout", help="Checkout a commit inside of a directory.")
 
@@ -312,20 +700,29 @@ def cmd_checkout(args):
     else:
         os.makedirs(args.path)
 
-    tree_checkout(repo, obj, os.path.realpath(args.path))
+    tree_checkout(repo, obj, os.path.realpath(args.path), repo.sparse_cone())
 
-def tree_checkout(repo, tree, path):
-    for item in tree.items:
-        obj = object_read(repo, item.sha)
+def tree_checkout(repo, tree, path, cone=None, prefix=""):
+    """Write the content of tree in directory path.  With a sparse
+    checkout cone, only the directories it includes are written, and
+    the others aren't even read."""
+    for item in tree.tree_iter():
         dest = os.path.join(path, item.path)
 
-        if obj.fmt == b'tree':
+        # The mode tells us the type, so we only read trees here, and
+        # copy blobs chunk by chunk as they're inflated.
+        if item.mode.startswith(b'04'):
+            subdir = prefix + item.path
+            if cone and cone.dir_state(subdir) == "out":
+                continue
             os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b'blob':
+            tree_checkout(repo, object_read(repo, item.sha), dest, cone, subdir + "/")
+        elif item.mode.startswith(b'10') or item.mode.startswith(b'12'):
             # @TODO Support symlinks (identified by mode 12****)
+            _, _, chunks = object_stream(repo, item.sha)
             with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
+                for chunk in chunks:
+                    f.write(chunk)
 
 def ref_resolve(repo, ref):
     path = repo.create_filerepo(ref)
@@ -404,7 +801,7 @@ def cmd_tag(args):
         tag_create(repo,
                    args.name,
                    args.object,
-                   type="object" if args.create_tag_object else "ref")
+                   create_tag_object=args.create_tag_object)
     else:
         refs = ref_list(repo)
         show_ref(repo, refs["tags"], with_hash=False)
@@ -415,7 +812,7 @@ def tag_create(repo, name, ref, create_tag_object=False):
 
     if create_tag_object:
         # create tag object (commit)
-        tag = GitTag(repo)
+        tag = GitTag()
         tag.kvlm = collections.OrderedDict()
         tag.kvlm[b'object'] = sha.encode()
         tag.kvlm[b'type'] = b'commit'
@@ -425,7 +822,8 @@ def tag_create(repo, name, ref, create_tag_object=False):
         tag.kvlm[b'tagger'] = b'Wyag <wyag@example.com>'
         # …and a tag message!
         tag.kvlm[None] = b"A tag generated by wyag, which won't let you customize the message!"
-        tag_sha = object_write(tag)
+        tag_sha = object_write(tag, repo)
+        repo.object_batch().flush()
         # create reference
         ref_create(repo, "tags/" + name, tag_sha)
     else:
@@ -433,8 +831,7 @@ def tag_create(repo, name, ref, create_tag_object=False):
         ref_create(repo, "tags/" + name, sha)
 
 def ref_create(repo, ref_name, sha):
-    with open(repo.create_filerepo("refs/" + ref_name), 'w') as fp:
-        fp.write(sha + "\n")
+    repo.write_atomic("refs/" + ref_name, (sha + "\n").encode("ascii"))
 
 def object_resolve(repo, name):
     """Resolve name to an object hash in repo.
@@ -462,16 +859,9 @@ This function is aware of:
         # This may be a hash, either small or full.  4 seems to be the
         # minimal length for git to consider something a short hash.
         # This limit is documented in man git-rev-parse
-        name = name.lower()
-        prefix = name[0:2]
-        path = repo.create_repo("objects", prefix, mkdir=False)
-        if path:
-            rem = name[2:]
-            for f in os.listdir(path):
-                if f.startswith(rem):
-                    # Notice a string startswith() itself, so this
-                    # works for full hashes.
-                    candidates.append(prefix + f)
+        # Notice a string startswith() itself, so this works for full
+        # hashes.
+        candidates.extend(object_resolve_prefix(repo, name.lower()))
 
     # Try for references.
     as_tag = ref_resolve(repo, "refs/tags/" + name)
@@ -499,23 +889,23 @@ def object_find(repo, name, fmt=None, follow=True):
           return sha
 
       while True:
-          obj = object_read(repo, sha)
-          #     ^^^^^^^^^^^ < this is a bit agressive: we're reading
-          # the full object just to get its type.  And we're doing
-          # that in a loop, albeit normally short.  Don't expect
-          # high performance here.
+          info = object_info(repo, sha)
+          #      ^^^^^^^^^^^ only reads the header: we don't pay for
+          # the full object unless we have to follow it.
+          if info is None:
+              raise Exception("No such object {0}.".format(sha))
 
-          if obj.fmt == fmt:
+          if info[0] == fmt:
               return sha
 
           if not follow:
               return None
 
           # Follow tags
-          if obj.fmt == b'tag':
-                sha = obj.kvlm[b'object'].decode("ascii")
-          elif obj.fmt == b'commit' and fmt == b'tree':
-                sha = obj.kvlm[b'tree'].decode("ascii")
+          if info[0] == b'tag':
+                sha = object_read(repo, sha).kvlm[b'object'].decode("ascii")
+          elif info[0] == b'commit' and fmt == b'tree':
+                sha = object_read(repo, sha).kvlm[b'tree'].decode("ascii")
           else:
               return None
 
@@ -559,7 +949,8 @@ def cmd_ls_files(args):
       print("  {} with perms: {:o}".format(
         { 0b1000: "regular file",
           0b1010: "symlink",
-          0b1110: "git link" }[e.mode_type],
+          0b1110: "git link",
+          0b0100: "sparse directory" }[e.mode_type],
         e.mode_perms))
       print("  on blob: {}".format(e.sha))
       print("  created: {}.{}, modified: {}.{}".format(
@@ -573,9 +964,10 @@ def cmd_ls_files(args):
         e.uid,
         grp.getgrgid(e.gid).gr_name,
         e.gid))
-      print("  flags: stage={} assume_valid={}".format(
+      print("  flags: stage={} assume_valid={} skip_worktree={}".format(
         e.flag_stage,
-        e.flag_assume_valid))
+        e.flag_assume_valid,
+        e.flag_skip_worktree))
 
 argsp = argsubparsers.add_parser("check-ignore", help = "Check path(s) against ignore rules.")
 argsp.add_argument("path", nargs="+", help="Paths to check")
@@ -611,7 +1003,14 @@ def gitignore_parse(lines):
 
 
 
-def gitignore_read(repo):
+def gitignore_global_file():
+    if "XDG_CONFIG_HOME" in os.environ:
+        config_home = os.environ["XDG_CONFIG_HOME"]
+    else:
+        config_home = os.path.expanduser("~/.config")
+    return os.path.join(config_home, "git/ignore")
+
+def gitignore_read(repo, index=None):
     ret = GitIgnore(absolute=list(), scoped=dict())
 
     # Read local configuration in .git/info/exclude
@@ -621,39 +1020,43 @@ def gitignore_read(repo):
             ret.absolute.append(gitignore_parse(f.readlines()))
 
     # Global configuration
-    if "XDG_CONFIG_HOME" in os.environ:
-        config_home = os.environ["XDG_CONFIG_HOME"]
-    else:
-        config_home = os.path.expanduser("~/.config")
-    global_file = os.path.join(config_home, "git/ignore")
+    global_file = gitignore_global_file()
 
     if os.path.exists(global_file):
         with open(global_file, "r") as f:
             ret.absolute.append(gitignore_parse(f.readlines()))
 
     # .gitignore files in the index
-    index = repo.read_index()
-
-    for entry in index.entries:
-        if entry.name == ".gitignore" or entry.name.endswith("/.gitignore"):
-            dir_name = os.path.dirname(entry.name)
-            contents = object_read(repo, entry.sha)
+    if index is None:
+        index = repo.read_index()
+
+    # Scan the names only: no need to materialize every entry to find
+    # the few .gitignore files.
+    for (i, name) in enumerate(index.names):
+        if name == ".gitignore" or name.endswith("/.gitignore"):
+            dir_name = os.path.dirname(name)
+            contents = object_read(repo, index.shas[20*i:20*i+20].hex())
             lines = contents.blobdata.decode("utf8").splitlines()
             ret.scoped[dir_name] = gitignore_parse(lines)
     return ret
 
-def check_ignore1(rules, path):
+def check_ignore1(rules, path, is_dir=False):
     result = None
     for (pattern, value) in rules:
+        # A pattern ending with a slash only matches directories.
+        if pattern.endswith("/"):
+            if not is_dir:
+                continue
+            pattern = pattern[:-1]
         if fnmatch(path, pattern):
             result = value
     return result
 
-def check_ignore_scoped(rules, path):
+def check_ignore_scoped(rules, path, is_dir=False):
     parent = os.path.dirname(path)
     while True:
         if parent in rules:
-            result = check_ignore1(rules[parent], path)
+            result = check_ignore1(rules[parent], path, is_dir)
             if result != None:
                 return result
         if parent == "":
@@ -661,26 +1064,87 @@ def check_ignore_scoped(rules, path):
         parent = os.path.dirname(parent)
     return None
 
-def check_ignore_absolute(rules, path):
+def check_ignore_absolute(rules, path, is_dir=False):
     parent = os.path.dirname(path)
     for ruleset in rules:
-        result = check_ignore1(ruleset, path)
+        result = check_ignore1(ruleset, path, is_dir)
         if result != None:
             return result
     return False # This is a reasonable default at this point.
 
-def check_ignore(rules, path):
+def check_ignore(rules, path, is_dir=False):
     if os.path.isabs(path):
         raise Exception("This function requires path to be relative to the repository's root")
 
-    result = check_ignore_scoped(rules.scoped, path)
+    result = check_ignore_scoped(rules.scoped, path, is_dir)
     if result != None:
         return result
 
-    return check_ignore_absolute(rules.absolute, path)
+    return check_ignore_absolute(rules.absolute, path, is_dir)
 
 argsp = argsubparsers.add_parser("status", help = "Show the working tree status.")
 
+argsp = argsubparsers.add_parser("update-index", help="Refresh the stat data of the index.")
+argsp.add_argument("--refresh",
+                   action="store_true",
+                   required=True,
+                   help="Store the stat data of the files which match their entry, and list those which don't.")
+
+def cmd_update_index(args):
+    repo = find_git_repo()
+    index = repo.read_index()
+
+    (refreshed, modified) = index_refresh(repo, index)
+    for (name, _) in modified:
+        print("{0}: needs update".format(name))
+
+    if refreshed:
+        repo.write_index(index)
+    if modified:
+        sys.exit(1)
+
+argsp = argsubparsers.add_parser("monitor", help="Watch the worktree, so status only checks what changed.")
+argsp.add_argument("action",
+                   choices=["start", "stop", "status", "run"],
+                   help="Start the monitor in the background, stop it, tell if it's running, or run it in the foreground.")
+
+def cmd_monitor(args):
+    repo = find_git_repo()
+    sock_path = repo.create_filerepo(MONITOR_SOCKET)
+
+    match args.action:
+        case "run":
+            GitMonitor(repo.worktree, repo.gitdir).run(sock_path)
+        case "start":
+            if monitor_query(sock_path, None):
+                print("The monitor is already running.")
+                return
+            if os.fork() == 0:
+                # Detach from the terminal and the caller's session.
+                os.setsid()
+                devnull = os.open(os.devnull, os.O_RDWR)
+                for fd in (0, 1, 2):
+                    os.dup2(devnull, fd)
+                try:
+                    GitMonitor(repo.worktree, repo.gitdir).run(sock_path)
+                finally:
+                    os._exit(0)
+            # Wait for it to answer.
+            for _ in range(100):
+                if monitor_query(sock_path, None):
+                    print("Monitor started.  Set core.monitor to true to use it.")
+                    return
+                time.sleep(0.05)
+            raise Exception("The monitor didn't start.")
+        case "stop":
+            if monitor_request(sock_path, "quit") is None:
+                print("The monitor isn't running.")
+        case "status":
+            if monitor_query(sock_path, None):
+                print("The monitor is running.")
+            else:
+                print("The monitor isn't running.")
+
 def cmd_status(_):
     repo = find_git_repo()
     index = repo.read_index()
@@ -688,7 +1152,10 @@ def cmd_status(_):
     cmd_status_branch(repo)
     cmd_status_head_index(repo, index)
     print()
-    cmd_status_index_worktree(repo, index)
+    if cmd_status_index_worktree(repo, index):
+        # Save the untracked cache, unless someone else is writing the
+        # index: it's only a cache.
+        repo.write_index(index, if_able=True)
 
 def branch_get_active(repo):
     with open(repo.create_filerepo("HEAD"), "r") as f:
@@ -707,23 +1174,26 @@ def cmd_status_branch(repo):
         print("HEAD detached at {}".format (object_find(repo, "HEAD")))
 
 def tree_to_dict(repo, ref, prefix=""):
-  ret = dict()
-  tree_sha = object_find(repo, ref, fmt=b"tree")
+  return tree_to_dict_sha(repo, object_find(repo, ref, fmt=b"tree"), prefix)
+
+def tree_to_dict_sha(repo, tree_sha, prefix="", ret=None):
+  if ret is None:
+      ret = dict()
   tree = object_read(repo, tree_sha)
 
-  for leaf in tree.items:
+  for leaf in tree.tree_iter():
       full_path = os.path.join(prefix, leaf.path)
 
-      # We read the object to extract its type (this is uselessly
-      # expensive: we could just open it as a file and read the
-      # first few bytes)
+      # The mode tells us the type, no need to read the object.
       is_subtree = leaf.mode.startswith(b'04')
 
       # Depending on the type, we either store the path (if it's a
       # blob, so a regular file), or recurse (if it's another tree,
       # so a subdir)
       if is_subtree:
-        ret.update(tree_to_dict(repo, leaf.sha, full_path))
+        # Fill the same dictionary rather than merging a new one at
+        # each level.
+        tree_to_dict_sha(repo, leaf.sha, full_path, ret)
       else:
         ret[full_path] = leaf.sha
 
@@ -732,195 +1202,798 @@ def tree_to_dict(repo, ref, prefix=""):
 def cmd_status_head_index(repo, index):
     print("Changes to be committed:")
 
-    head = tree_to_dict(repo, "HEAD")
-    for entry in index.entries:
-        if entry.name in head:
-            if head[entry.name] != entry.sha:
-                print("  modified:", entry.name)
-            del head[entry.name] # Delete the key
-        else:
-            print("  added:   ", entry.name)
-
-    # Keys still in HEAD are files that we haven't met in the index,
-    # and thus have been deleted.
-    for entry in head.keys():
-        print("  deleted: ", entry)
-
-def cmd_status_index_worktree(repo, index):
-    print("Changes not staged for commit:")
+    # Before the first commit, there's no tree: everything is added.
+    tree_sha = None
+    if ref_resolve(repo, "HEAD") is not None:
+        tree_sha = object_find(repo, "HEAD", fmt=b"tree")
+
+    changes = list()
+    index_diff_tree(repo, index, tree_sha, changes)
+    for (name, change) in sorted(changes):
+        print("  {0:<9}".format(change + ":"), name)
+
+def index_diff_tree(repo, index, tree_sha, ret):
+    """Compare index with tree tree_sha (HEAD's), appending (path,
+    "added", "modified" or "deleted") to ret for each file that differs.
+
+    The tree and the sorted index are walked together, a directory at a
+    time.  The cached tree of the index (see GitCacheTree) has the SHA
+    the tree of each directory would have: when it's the SHA of the
+    matching tree, the directory is skipped, without reading its tree or
+    looking at its entries.  So with a valid cached tree, comparing
+    costs in the number of directories with changes, not in the size of
+    the repository."""
+    names = index.names
+    order = index.order()
+
+    def old_dir(leaf, path):
+        # The SHA of leaf if it's a tree.  If it's a file, a directory of
+        # the index replaced it.
+        if leaf is None:
+            return None
+        if leaf.mode.startswith(b"04"):
+            return leaf.sha
+        ret.append((path, "deleted"))
+        return None
 
-    ignore = gitignore_read(repo)
+    def diff(tree_sha, prefix, node, pos, end):
+        """Compare the tree tree_sha (or None) of directory prefix (""
+        or ending with a /) with the entries order[pos:end] of the index,
+        whose cached tree is node (or None)."""
+        if tree_sha is not None and node is not None and node.valid() and node.binsha.hex() == tree_sha:
+            return
+
+        leaves = dict()
+        if tree_sha is not None:
+            for leaf in object_read(repo, tree_sha).tree_iter():
+                leaves[leaf.path] = leaf
+
+        while pos < end:
+            i = order[pos]
+            rest = names[i][len(prefix):]
+            if index.mode[i] == INDEX_SPARSE_DIR_MODE and not "/" in rest[:-1]:
+                # The whole tree of a subdirectory outside the sparse
+                # checkout.  Deeper ones are found by recursing.
+                base = rest[:-1]
+                old = old_dir(leaves.pop(base, None), prefix + base)
+                tree_diff(repo, old, index.shas[20*i:20*i+20].hex(), prefix + base, ret)
+                pos += 1
+            elif "/" in rest:
+                base = rest.split("/", 1)[0]
+                old = old_dir(leaves.pop(base, None), prefix + base)
+                sub = node.subtrees.get(base) if node is not None else None
+                (_, sub_end) = index.under(prefix + base)
+                diff(old, prefix + base + "/", sub, pos, sub_end)
+                pos = sub_end
+            else:
+                leaf = leaves.pop(rest, None)
+                if leaf is None:
+                    ret.append((names[i], "added"))
+                elif leaf.mode.startswith(b"04"):
+                    ret.append((names[i], "added"))
+                    tree_diff(repo, leaf.sha, None, names[i], ret)
+                elif leaf.sha != index.shas[20*i:20*i+20].hex():
+                    ret.append((names[i], "modified"))
+                # Skip the other stages of the path, if any.
+                pos += 1
+                while pos < end and names[order[pos]] == names[i]:
+                    pos += 1
+
+        # What's left of the tree isn't in the index anymore.
+        for (name, leaf) in leaves.items():
+            if leaf.mode.startswith(b"04"):
+                tree_diff(repo, leaf.sha, None, prefix + name, ret)
+            else:
+                ret.append((prefix + name, "deleted"))
 
-    gitdir_prefix = repo.gitdir + os.path.sep
+    diff(tree_sha, "", index.cache_tree, 0, len(index))
 
-    all_files = list()
+def tree_diff(repo, old, new, prefix, ret):
+    """Compare trees old and new (SHAs, or None for no tree) of
+    directory prefix ("" for the root), appending to ret like
+    index_diff_tree.  Identical subtrees are skipped."""
+    if old == new:
+        return
+    a = dict() if old is None else { leaf.path: leaf for leaf in object_read(repo, old).tree_iter() }
+    b = dict() if new is None else { leaf.path: leaf for leaf in object_read(repo, new).tree_iter() }
+
+    for name in sorted(a.keys() | b.keys()):
+        path = prefix + "/" + name if prefix else name
+        x = a.get(name)
+        y = b.get(name)
+        x_dir = x is not None and x.mode.startswith(b"04")
+        y_dir = y is not None and y.mode.startswith(b"04")
+        if x_dir or y_dir:
+            tree_diff(repo, x.sha if x_dir else None, y.sha if y_dir else None, path, ret)
+        if x is not None and not x_dir and (y is None or y_dir):
+            ret.append((path, "deleted"))
+        elif y is not None and not y_dir and (x is None or x_dir):
+            ret.append((path, "added"))
+        elif x is not None and y is not None and not (x_dir or y_dir) and x.sha != y.sha:
+            ret.append((path, "modified"))
 
-    # We begin by walking the filesystem
-    for (root, _, files) in os.walk(repo.worktree, True):
-        if root==repo.gitdir or root.startswith(gitdir_prefix):
-            continue
-        for f in files:
-            full_path = os.path.join(root, f)
-            rel_path = os.path.relpath(full_path, repo.worktree)
-            all_files.append(rel_path)
+def cmd_status_index_worktree(repo, index):
+    """Print the changes between the index and the worktree, and the
+    untracked files.  Return True if the index was modified (its
+    untracked cache or monitor token) and should be written back."""
+    print("Changes not staged for commit:")
 
-    # We now traverse the index, and compare real files with the cached
-    # versions.
+    ignore = gitignore_read(repo, index)
 
-    for entry in index.entries:
-        full_path = os.path.join(repo.worktree, entry.name)
+    # If the monitor is running, it tells us which entries may have
+    # changed; otherwise we check them all.
+    old_token = index.fsmonitor_token
+    check = monitor_changed(repo, index)
+    dirty = set()
 
-        # That file *name* is in the index
+    # We stat the files of the index entries (in parallel), then only
+    # read those whose metadata changed, to compare them with the cached
+    # versions.  Files which didn't actually change get their new stat
+    # data in the index, so we won't read them next time.
+    (refreshed, modified) = index_refresh(repo, index, check)
 
-        if not os.path.exists(full_path):
-            print("  deleted: ", entry.name)
+    for (name, state) in modified:
+        if state == PRELOAD_DELETED:
+            print("  deleted: ", name)
         else:
-            stat = os.stat(full_path)
-
-            # Compare metadata
-            ctime_ns = entry.ctime[0] * 10**9 + entry.ctime[1]
-            mtime_ns = entry.mtime[0] * 10**9 + entry.mtime[1]
-            if (stat.st_ctime_ns != ctime_ns) or (stat.st_mtime_ns != mtime_ns):
-                # If different, deep compare.
-                # @FIXME This *will* crash on symlinks to dir.
-                with open(full_path, "rb") as fd:
-                    new_sha = object_hash(fd, b"blob", None)
-                    # If the hashes are the same, the files are actually the same.
-                    same = entry.sha == new_sha
-
-                    if not same:
-                        print("  modified:", entry.name)
+            print("  modified:", name)
+        dirty.add(name)
 
-        if entry.name in all_files:
-            all_files.remove(entry.name)
+    if repo.conf.getboolean("core", "untrackedCache", fallback=False):
+        (untracked, changed) = untracked_cached(repo, index, ignore)
+    else:
+        untracked = untracked_walk(repo, index, ignore)
+        # Drop a cache we're not going to maintain.
+        changed = index.untracked_cache is not None
+        index.untracked_cache = None
+    changed = changed or refreshed > 0
+
+    # Entries we didn't check matched at the previous token, and
+    # haven't changed since.
+    if index.fsmonitor_token is not None:
+        changed = changed or index.fsmonitor_token != old_token or index.fsmonitor_dirty != dirty
+        index.fsmonitor_dirty = dirty
+    elif old_token is not None:
+        changed = True
 
     print()
     print("Untracked files:")
 
-    for f in all_files:
-        # @TODO If a full directory is untracked, we should display
-        # its name without its contents.
-        if not check_ignore(ignore, f):
-            print(" ", f)
+    for f in untracked:
+        print(" ", f)
+
+    return changed
+
+# What index_preload finds for each entry.
+PRELOAD_CLEAN = 0   # Its stat data match: the file is unchanged.
+PRELOAD_CHANGED = 1 # They don't: the content has to be compared.
+PRELOAD_DELETED = 2
+
+# Below this many entries per thread, starting threads costs more than
+# it saves.  That's git's figure.
+PRELOAD_PER_THREAD = 500
+
+def index_preload(repo, index, check=None):
+    """lstat() the files of the entries of index, and return a bytearray
+    with the PRELOAD_* state of each entry.  Only the entries named in
+    check are looked at, unless it's None; entries outside the sparse
+    checkout are CLEAN.
+
+    With core.preloadIndex (the default), entries are split between
+    core.preloadThreads threads (one per CPU by default), so that the
+    latency of each lstat(), which on network or overlay filesystems is
+    most of the cost, overlaps with the others'.  Small indexes are done
+    serially."""
+    count = len(index)
+    states = bytearray(count)
+    names = index.names
+    flags = index.flags
+    worktree = repo.worktree
+
+    def preload(start, end):
+        # Each thread sets its own range of states.
+        for i in range(start, end):
+            name = names[i]
+            if check is not None and not name in check:
+                continue
+            if flags[i] & INDEX_SKIP_WORKTREE:
+                continue
+            try:
+                st = os.lstat(os.path.join(worktree, name))
+            except (FileNotFoundError, NotADirectoryError):
+                states[i] = PRELOAD_DELETED
+                continue
+            if S_ISDIR(st.st_mode):
+                # The file was replaced by a directory.
+                states[i] = PRELOAD_DELETED
+            elif not index.stat_matches(i, st):
+                states[i] = PRELOAD_CHANGED
+
+    jobs = 1
+    if repo.conf.getboolean("core", "preloadIndex", fallback=True):
+        jobs = int(repo.conf.get("core", "preloadThreads", fallback=0)) or os.cpu_count() or 1
+        jobs = max(1, min(jobs, count // PRELOAD_PER_THREAD))
+
+    if jobs == 1:
+        preload(0, count)
+        return states
+
+    step = ceil(count / jobs)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [ pool.submit(preload, start, min(start + step, count))
+                    for start in range(0, count, step) ]
+        for f in futures:
+            f.result()
+    return states
+
+def index_refresh(repo, index, check=None):
+    """Compare the entries of index (those named in check, unless it's
+    None) with their files, by stat data first (see index_preload), then
+    by content for those whose stat data don't match.  Files whose
+    content matches get their new stat data in index.
+
+    Return the number of entries refreshed, and the list of (name,
+    PRELOAD_CHANGED or PRELOAD_DELETED) of those which really changed,
+    in the order of the index."""
+    states = index_preload(repo, index, check)
+    refreshed = 0
+    modified = list()
+
+    for (i, name) in enumerate(index.names):
+        if states[i] == PRELOAD_CLEAN:
+            continue
 
-def write_index(repo, index):
-    with open(repo.create_filerepo("index"), "wb") as f:
+        if states[i] == PRELOAD_DELETED:
+            modified.append((name, PRELOAD_DELETED))
+            continue
 
-        # HEADER
+        # Deep compare.  The stat is taken before reading: if the file
+        # changes while we do, the stat data we store won't match it.
+        # Symlinks are hashed as git stores them, not followed.
+        full_path = os.path.join(repo.worktree, name)
+        (new_sha, st) = object_hash_path(full_path, None, follow=False)
+        if index.shas[20*i:20*i+20].hex() != new_sha:
+            modified.append((name, PRELOAD_CHANGED))
+            continue
 
-        # Write the magic bytes.
-        f.write(b"DIRC")
-        # Write version number.
-        f.write(index.version.to_bytes(4, "big"))
-        # Write the number of entries.
-        f.write(len(index.entries).to_bytes(4, "big"))
+        # If the hashes are the same, the files are actually the same.
+        # Even if the file is modified again in the same instant, so its
+        # mtime doesn't change, the index we'll write won't be older
+        # than that mtime: the entry will be racy (see stat_matches), and
+        # compared by content again.
+        index.set_stat(i, st)
+        refreshed += 1
+
+    return (refreshed, modified)
+
+def monitor_changed(repo, index):
+    """With core.monitor, ask the monitor (see libgitmonitor) what
+    changed since index's token, and return the set of the names of
+    the entries which may not match the worktree anymore: those it
+    reports, those below a directory it reports, and those which
+    didn't match last time.  The new token is stored in index; the
+    caller updates index.fsmonitor_dirty after checking them.
+
+    Return None if everything must be checked: no monitor, or no
+    token, or a stale one."""
+    if not repo.conf.getboolean("core", "monitor", fallback=False):
+        index.fsmonitor_token = None
+        index.fsmonitor_dirty = set()
+        return None
 
-        # ENTRIES
+    answer = monitor_query(repo.create_filerepo(MONITOR_SOCKET), index.fsmonitor_token)
+    if answer is None:
+        # No monitor: next time, it may have missed changes.
+        index.fsmonitor_token = None
+        index.fsmonitor_dirty = set()
+        return None
 
-        idx = 0
-        for e in index.entries:
-            f.write(e.ctime[0].to_bytes(4, "big"))
-            f.write(e.ctime[1].to_bytes(4, "big"))
-            f.write(e.mtime[0].to_bytes(4, "big"))
-            f.write(e.mtime[1].to_bytes(4, "big"))
-            f.write(e.dev.to_bytes(4, "big"))
-            f.write(e.ino.to_bytes(4, "big"))
+    (token, paths) = answer
+    known = index.fsmonitor_token is not None
+    index.fsmonitor_token = token
+    if paths is None or not known:
+        return None
 
-            # Mode
-            mode = (e.mode_type << 12) | e.mode_perms
-            f.write(mode.to_bytes(4, "big"))
+    ret = set(index.fsmonitor_dirty)
+    order = index.order()
+    for path in paths:
+        if index.find(path) is not None:
+            ret.add(path)
+        # Everything below, if path is a directory.
+        (start, end) = index.under(path)
+        ret.update([index.names[i] for i in order[start:end]])
+    return ret
 
-            f.write(e.uid.to_bytes(4, "big"))
-            f.write(e.gid.to_bytes(4, "big"))
+def untracked_walk(repo, index, ignore):
+    """Return the sorted list of the untracked files of the worktree,
+    walking all of it.  Like git, a directory without any tracked file
+    is listed once, as "dir/", if there's anything untracked in it.
 
-            f.write(e.fsize.to_bytes(4, "big"))
-            # @FIXME Convert back to int.
-            f.write(int(e.sha, 16).to_bytes(20, "big"))
+    Directories are listed with scandir(), whose entries know their
+    type without a stat(); ignored directories aren't entered at all,
+    and untracked ones only until we find a file which isn't ignored."""
+    ret = list()
 
-            flag_assume_valid = 0x1 << 15 if e.flag_assume_valid else 0
+    def scan(path, prefix):
+        with os.scandir(path) as it:
+            for entry in it:
+                rel_path = prefix + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name == ".git" or check_ignore(ignore, rel_path, True):
+                        continue
+                    (start, end) = index.under(rel_path)
+                    if start < end:
+                        scan(entry.path, rel_path + "/")
+                    elif untracked_any(ignore, entry.path, rel_path + "/"):
+                        ret.append(rel_path + "/")
+                elif index.find(rel_path) is None and not check_ignore(ignore, rel_path):
+                    ret.append(rel_path)
+
+    scan(repo.worktree, "")
+    return sorted(ret)
+
+def untracked_any(ignore, path, prefix):
+    """Whether directory path, relative path prefix (ending with a
+    slash), holds a file which isn't ignored."""
+    with os.scandir(path) as it:
+        for entry in it:
+            rel_path = prefix + entry.name
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name == ".git" or check_ignore(ignore, rel_path, True):
+                    continue
+                if untracked_any(ignore, entry.path, rel_path + "/"):
+                    return True
+            elif not check_ignore(ignore, rel_path):
+                return True
+    return False
+
+def untracked_collapse(index, files):
+    """Replace the untracked files in directories without any tracked
+    file by their outermost such directory, as "dir/", like
+    untracked_walk does."""
+    ret = list()
+    for f in files:
+        parts = f.split("/")
+        for n in range(1, len(parts)):
+            d = "/".join(parts[:n])
+            (start, end) = index.under(d)
+            if start == end:
+                f = d + "/"
+                break
+        if not ret or ret[-1] != f:
+            ret.append(f)
+    return ret
 
-            name_bytes = e.name.encode("utf8")
-            bytes_len = len(name_bytes)
-            if bytes_len >= 0xFFF:
-                name_length = 0xFFF
-            else:
-                name_length = bytes_len
+def untracked_file_state(path):
+    """Return (stat_data, binary SHA of the content) of the ignore file
+    path, or (None, None) if it doesn't exist."""
+    if not os.path.exists(path):
+        return (None, None)
+    with open(path, "rb") as fd:
+        return (stat_data(os.fstat(fd.fileno())), bytes.fromhex(object_hash(fd, b"blob", None)))
+
+def untracked_cached(repo, index, ignore):
+    """Return the sorted list of the untracked files of the worktree,
+    using and updating the untracked cache of index (core.untrackedCache).
+
+    Each directory is stat()ed, but only listed, and its files matched
+    against the ignore rules, if its stat data changed since the cached
+    listing (so a file was created, deleted or renamed in it), if the
+    index changed under it (add and rm invalidate the cache), or if its
+    .gitignore or one of its parents' changed.  Return the list, and
+    whether the cache was updated."""
+    ident = "Location {0}, system {1}".format(repo.worktree, os.uname().sysname).encode("utf8") + b"\x00"
+    info_exclude = untracked_file_state(os.path.join(repo.gitdir, "info/exclude"))
+    excludes_file = untracked_file_state(gitignore_global_file())
+
+    uc = index.untracked_cache
+    changed = False
+    if (uc is None or uc.ident != ident or uc.dir_flags != GitUntrackedCache.DIR_FLAGS
+        or uc.info_exclude != info_exclude or uc.excludes_file != excludes_file):
+        # No cache, or one we can't trust: start over.
+        uc = index.untracked_cache = GitUntrackedCache(ident)
+        uc.info_exclude = info_exclude
+        uc.excludes_file = excludes_file
+        changed = True
+    if uc.root is None:
+        uc.root = GitUntrackedDir()
+
+    # The .gitignore of each directory, as wyag reads them: from the
+    # index.
+    exclude_shas = dict()
+    for i, name in enumerate(index.names):
+        if name == ".gitignore" or name.endswith("/.gitignore"):
+            exclude_shas[os.path.dirname(name)] = bytes(index.shas[20*i:20*i+20])
 
-            # We merge back three pieces of data (two flags and the
-            # length of the name) on the same two bytes.
-            f.write((flag_assume_valid | e.flag_stage | name_length).to_bytes(2, "big"))
+    ret = list()
 
-            # Write back the name, and a final 0x00.
-            f.write(name_bytes)
-            f.write((0).to_bytes(1, "big"))
+    def scan(path, node, force):
+        nonlocal changed
+        full_path = os.path.join(repo.worktree, path)
+        try:
+            # Before listing: if the directory changes while we're at
+            # it, the next run will notice.
+            stat = stat_data(os.stat(full_path))
+        except FileNotFoundError:
+            node.valid = False
+            return
+
+        exclude_sha = exclude_shas.get(path)
+        # New ignore rules apply to all the subdirectories too.
+        force = force or exclude_sha != node.exclude_sha
+
+        if force or not node.valid or node.stat != stat:
+            untracked = list()
+            subdirs = dict()
+            with os.scandir(full_path) as it:
+                for entry in it:
+                    rel_path = os.path.join(path, entry.name)
+                    if entry.is_dir():
+                        # Like os.walk, don't follow symlinks.
+                        if entry.is_symlink() or entry.name == ".git" or check_ignore(ignore, rel_path, True):
+                            continue
+                        subdirs[entry.name] = node.subdirs.get(entry.name) or GitUntrackedDir()
+                    elif index.find(rel_path) is None and not check_ignore(ignore, rel_path):
+                        untracked.append(entry.name)
+            node.untracked = sorted(untracked)
+            node.subdirs = dict(sorted(subdirs.items()))
+            node.stat = stat
+            node.exclude_sha = exclude_sha
+            node.valid = True
+            changed = True
+
+        ret.extend([os.path.join(path, f) for f in node.untracked])
+        for name, sub in node.subdirs.items():
+            scan(os.path.join(path, name), sub, force)
+
+    scan("", uc.root, False)
+    return (untracked_collapse(index, sorted(ret)), changed)
+
+argsp = argsubparsers.add_parser("sparse-checkout", help="Only keep some directories in the worktree.")
+argsp.add_argument("action",
+                   choices=["set", "add", "list", "disable"],
+                   help="Set or add the directories to keep, list them, or go back to a full worktree.")
+argsp.add_argument("dirs",
+                   nargs="*",
+                   help="The directories to keep, with everything below.")
+argsp.add_argument("--sparse-index",
+                   action="store_true",
+                   help="Also collapse the directories outside the sparse checkout in the index (index.sparse).")
 
-            idx += 62 + len(name_bytes) + 1
+def cmd_sparse_checkout(args):
+    repo = find_git_repo()
 
-            # Add padding if necessary.
-            if idx % 8 != 0:
-                pad = 8 - (idx % 8)
-                f.write((0).to_bytes(pad, "big"))
-                idx += pad
+    match args.action:
+        case "list":
+            cone = repo.sparse_cone()
+            if cone is None:
+                raise Exception("This worktree isn't sparse.")
+            for d in sorted(cone.recursive):
+                print(d)
+            return
+        case "disable":
+            repo.conf_set("core", "sparseCheckout", "false")
+            sparse_reapply(repo, repo.read_index(), None)
+            return
+
+    cone = repo.sparse_cone() if args.action == "add" else None
+    if cone is None:
+        cone = GitSparseCone()
+    for d in args.dirs:
+        cone.add(os.path.relpath(os.path.abspath(d), repo.worktree))
+
+    repo.write_atomic("info/sparse-checkout", cone.serialize().encode("utf8"))
+    repo.conf_set("core", "sparseCheckout", "true")
+    repo.conf_set("core", "sparseCheckoutCone", "true")
+    if args.sparse_index:
+        repo.conf_set("index", "sparse", "true")
+    sparse_reapply(repo, repo.read_index(), cone)
+
+def sparse_reapply(repo, index, cone):
+    """Make the worktree and index match the sparse checkout cone (None
+    for a full checkout): write the files it includes, remove the others
+    (unless they were modified), and mark them skip-worktree in the
+    index.  With index.sparse, directories outside the cone are then
+    collapsed to a single entry each."""
+    index_expand(repo, index)
+
+    for (i, name) in enumerate(index.names):
+        e = index.entry(i)
+        full_path = os.path.join(repo.worktree, name)
+        if cone is None or cone.includes(name):
+            if not e.flag_skip_worktree:
+                continue
+            if not os.path.lexists(full_path):
+                os.makedirs(os.path.dirname(full_path), exist_ok=True)
+                _, _, chunks = object_stream(repo, e.sha)
+                with open(full_path, "wb") as f:
+                    for chunk in chunks:
+                        f.write(chunk)
+                stat = os.stat(full_path)
+            else:
+                # Someone put a file there: only take its stat data if
+                # it's what the index has.
+                stat = os.stat(full_path)
+                with open(full_path, "rb") as fd:
+                    if object_hash(fd, b"blob", None) != e.sha:
+                        print("Not overwriting {0}, which has local changes.".format(name))
+                        stat = None
+            if stat is None:
+                # Zeroed stat data never match: status will compare the
+                # content, and report the change.
+                (e.ctime, e.mtime) = ((0, 0), (0, 0))
+                (e.dev, e.ino, e.uid, e.gid, e.fsize) = (0, 0, 0, 0, 0)
+            else:
+                e.ctime = (int(stat.st_ctime), stat.st_ctime_ns % 10**9)
+                e.mtime = (int(stat.st_mtime), stat.st_mtime_ns % 10**9)
+                (e.dev, e.ino, e.uid, e.gid, e.fsize) = (stat.st_dev, stat.st_ino, stat.st_uid, stat.st_gid, stat.st_size)
+            e.flag_skip_worktree = False
+        else:
+            if e.flag_skip_worktree:
+                continue
+            if os.path.lexists(full_path):
+                with open(full_path, "rb") as fd:
+                    if object_hash(fd, b"blob", None) != e.sha:
+                        print("Not removing {0}, which has local changes.".format(name))
+                        continue
+                os.unlink(full_path)
+                try:
+                    os.removedirs(os.path.dirname(full_path))
+                except OSError:
+                    pass # Not empty.
+            e.flag_skip_worktree = True
+        index.set_entry(i, e)
+
+    if cone is not None and repo.conf.getboolean("index", "sparse", fallback=False):
+        index_collapse(repo, index, cone)
+
+    # Collapsing writes trees: they must be in place before the index
+    # points to them.
+    repo.object_batch().flush()
+    repo.write_index(index)
+
+def tree_walk_files(repo, tree_sha, prefix=""):
+    """Yield (path, mode, SHA) for every file under tree tree_sha."""
+    for leaf in object_read(repo, tree_sha).tree_iter():
+        path = prefix + "/" + leaf.path if prefix else leaf.path
+        if leaf.mode.startswith(b"04"):
+            yield from tree_walk_files(repo, leaf.sha, path)
+        else:
+            yield (path, leaf.mode, leaf.sha)
+
+def index_expand(repo, index):
+    """Replace the sparse directory entries of index by the files of
+    their trees, all skip-worktree."""
+    if not INDEX_SPARSE_DIR_MODE in index.mode:
+        return
+    entries = list()
+    for e in index.entries:
+        if e.mode_type != INDEX_SPARSE_DIR_MODE >> 12:
+            entries.append(e)
+            continue
+        # The cached trees still have the right SHAs, but not the right
+        # number of entries.
+        index.invalidate_path(e.name)
+        for (path, mode, sha) in tree_walk_files(repo, e.sha, e.name[:-1]):
+            mode = int(mode, 8)
+            entries.append(GitIndexEntry(ctime=(0, 0), mtime=(0, 0), dev=0, ino=0,
+                                         mode_type=mode >> 12, mode_perms=mode & 0o777,
+                                         uid=0, gid=0, fsize=0, sha=sha,
+                                         flag_assume_valid=False, flag_stage=0,
+                                         flag_skip_worktree=True, name=path))
+    index.entries = entries
+
+def index_collapse(repo, index, cone):
+    """Replace the entries of each directory outside cone by a single
+    sparse directory entry, with the SHA of its tree, if they're all
+    skip-worktree: everything that reads the index then only pays for
+    the sparse checkout."""
+    # This writes the missing trees, and makes the cached tree valid
+    # everywhere: it has the SHA of every directory.
+    tree_from_index(repo, index)
+
+    names = index.names
+    order = index.order()
+    entries = list()
+
+    def collapse(pos, prefix, node):
+        """Copy the entries of directory prefix, starting at order[pos],
+        to entries, collapsing its subdirectories.  Return the position
+        following its last entry."""
+        start = len(entries)
+        while pos < len(order) and names[order[pos]].startswith(prefix):
+            i = order[pos]
+            rest = names[i][len(prefix):]
+            if not "/" in rest or index.mode[i] == INDEX_SPARSE_DIR_MODE and not "/" in rest[:-1]:
+                entries.append(index.entry(i))
+                pos += 1
+                continue
+            base = rest.split("/", 1)[0]
+            sub = node.subtrees[base]
+            end = pos + sub.entry_count
+            if (cone.dir_state(prefix + base) == "out"
+                and all([index.flags[order[j]] & INDEX_SKIP_WORKTREE for j in range(pos, end)])):
+                entries.append(GitIndexEntry(ctime=(0, 0), mtime=(0, 0), dev=0, ino=0,
+                                             mode_type=INDEX_SPARSE_DIR_MODE >> 12, mode_perms=0,
+                                             uid=0, gid=0, fsize=0, sha=sub.binsha.hex(),
+                                             flag_assume_valid=False, flag_stage=0,
+                                             flag_skip_worktree=True, name=prefix + base + "/"))
+                # Sparse directories are leaves of the cached tree.
+                del node.subtrees[base]
+                pos = end
+            else:
+                pos = collapse(pos, prefix + base + "/", sub)
+        node.entry_count = len(entries) - start
+        return pos
+
+    collapse(0, "", index.cache_tree)
+    index.entries = entries
 
 argsp = argsubparsers.add_parser("rm", help="Remove files from the working tree and the index.")
 argsp.add_argument("path", nargs="+", help="Files to remove")
 
 def cmd_rm(args):
   repo:GitRepository = find_git_repo()
-  repo.rm_path(repo, args.path)
+  repo.rm_path(args.path)
 
 argsp = argsubparsers.add_parser("add", help = "Add files contents to the index.")
-argsp.add_argument("path", nargs="+", help="Files to add")
+argsp.add_argument("path", nargs="*", help="Files or directories to add")
+argsp.add_argument("-A", "--all",
+                   action="store_true",
+                   help="Add untracked files too, and remove deleted ones (in the whole worktree if no path is given).")
+argsp.add_argument("-u", "--update",
+                   action="store_true",
+                   help="Only update files already in the index, and remove deleted ones (in the whole worktree if no path is given).")
 
 def cmd_add(args) -> GitRepository:
   repo:GitRepository = find_git_repo()
-  add(repo, args.path)
+  if not args.path and not (args.all or args.update):
+    raise Exception("Nothing specified, nothing added.")
+  add(repo, args.path, all=args.all, update=args.update)
   return repo
 
-def add(repo, paths, delete=True, skip_missing=False):
+def add(repo, paths, all=False, update=False):
+  """Add paths, files or directories, to the index.  Without update,
+  untracked files below the directories are added, unless they're
+  ignored; with it, only the files already in the index are.  Index
+  entries whose file was deleted are removed, for directories, or for
+  all and update (with which no paths means the whole worktree).
 
-  # First remove all paths from the index, if they exist.
-  repo.rm_path(repo, paths, delete=False, skip_missing=True)
+  The index is read and written once, and each file is lstat()ed and
+  only hashed if its stat data don't match its entry: re-adding a large
+  tree only costs for what changed."""
 
   worktree = repo.worktree + os.sep
-
-  # Convert the paths to pairs: (absolute, relative_to_worktree).
-  # Also delete them from the index if they're present.
-  clean_paths = list()
+  cone = repo.sparse_cone()
+  index = repo.read_index()
+  ignore = None
+
+  if not paths:
+    paths = [ repo.worktree ]
+
+  # With update, the monitor may tell us which entries to check.
+  check = None
+  if update and not all:
+    check = monitor_changed(repo, index)
+    if check is None:
+      # monitor_changed may have a new token, but we won't check all the
+      # entries to find which match it.
+      index.fsmonitor_token = None
+      index.fsmonitor_dirty = set()
+  monitored = check is not None
+
+  # The paths to consider, relative to the worktree.
+  names = dict()
   for path in paths:
     abspath = os.path.abspath(path)
-    if not (abspath.startswith(worktree) and os.path.isfile(abspath)):
-      raise Exception("Not a file, or outside the worktree: {}".format(paths))
-    relpath = os.path.relpath(abspath, repo.worktree)
-    clean_paths.append((abspath,  relpath))
-
-    # Find and read the index.  It was modified by rm.  (This isn't
-    # optimal, good enough for wyag!)
-    #
-    # @FIXME, though: we could just
-    # move the index through commands instead of reading and writing
-    # it over again.
-    index = repo.read_index()
-
-    for (abspath, relpath) in clean_paths:
-      with open(abspath, "rb") as fd:
-        sha = object_hash(fd, b"blob", repo)
-
-      stat = os.stat(abspath)
-
-      ctime_s = int(stat.st_ctime)
-      ctime_ns = stat.st_ctime_ns % 10**9
-      mtime_s = int(stat.st_mtime)
-      mtime_ns = stat.st_mtime_ns % 10**9
-
-      entry = GitIndexEntry(ctime=(ctime_s, ctime_ns), mtime=(mtime_s, mtime_ns), dev=stat.st_dev, ino=stat.st_ino,
-                            mode_type=0b1000, mode_perms=0o644, uid=stat.st_uid, gid=stat.st_gid,
-                            fsize=stat.st_size, sha=sha, flag_assume_valid=False,
-                            flag_stage=False, name=relpath)
+    if not (abspath == repo.worktree or abspath.startswith(worktree)):
+      raise Exception("Outside the worktree: {}".format(path))
+    relpath = "" if abspath == repo.worktree else os.path.relpath(abspath, repo.worktree)
+
+    if os.path.isdir(abspath) and not os.path.islink(abspath):
+      if update and not all:
+        (start, end) = index.under(relpath)
+        order = index.order()
+        for i in order[start:end]:
+          if check is None or index.names[i] in check:
+            names[index.names[i]] = None
+        continue
+      if ignore is None:
+        ignore = gitignore_read(repo, index)
+      for name in add_walk(repo, index, relpath, ignore, cone):
+        names[name] = None
+      # Deleted files, which the walk didn't see.
+      (start, end) = index.under(relpath)
+      for i in index.order()[start:end]:
+        names[index.names[i]] = None
+    elif os.path.islink(abspath) or os.path.isfile(abspath) or index.find(relpath) is not None and (all or update):
+      if cone and not cone.includes(relpath):
+        raise Exception("Outside of the sparse-checkout cone: {}".format(relpath))
+      names[relpath] = None
+    else:
+      raise Exception("Not a file, or outside the worktree: {}".format(path))
+
+  # Sort what changed from what didn't, without reading anything.
+  changed = list()
+  drop = list()
+  for name in names:
+    positions = index.find_all(name)
+    # Files outside the sparse checkout aren't in the worktree.
+    if positions and index.flags[positions[0]] & INDEX_SKIP_WORKTREE:
+      continue
+    try:
+      st = os.lstat(os.path.join(repo.worktree, name))
+    except (FileNotFoundError, NotADirectoryError):
+      st = None
+    # A file replaced by a directory is gone too: the files in the
+    # directory replace its entry.
+    if st is None or S_ISDIR(st.st_mode):
+      if positions:
+        drop.extend(positions)
+        index.invalidate_path(name)
+      continue
+    if not (S_ISREG(st.st_mode) or S_ISLNK(st.st_mode)):
+      print("Skipping {0}: not a regular file or a symlink.".format(name))
+      continue
+    if len(positions) == 1 and index.stat_matches(positions[0], st):
+      continue
+    changed.append((name, positions))
+
+  # Hash, compress and write the blobs concurrently.  Results come back
+  # in the order of paths, whichever finishes first.
+  hashed = object_hash_paths(repo, [ os.path.join(repo.worktree, name) for (name, _) in changed ], follow=False)
+
+  for ((relpath, positions), (sha, stat)) in zip(changed, hashed):
+    ctime_s = int(stat.st_ctime)
+    ctime_ns = stat.st_ctime_ns % 10**9
+    mtime_s = int(stat.st_mtime)
+    mtime_ns = stat.st_mtime_ns % 10**9
+
+    entry = GitIndexEntry(ctime=(ctime_s, ctime_ns), mtime=(mtime_s, mtime_ns), dev=stat.st_dev, ino=stat.st_ino,
+                          mode_type=0b1010 if S_ISLNK(stat.st_mode) else 0b1000,
+                          mode_perms=0 if S_ISLNK(stat.st_mode) else 0o644,
+                          uid=stat.st_uid, gid=stat.st_gid,
+                          fsize=stat.st_size, sha=sha, flag_assume_valid=False,
+                          flag_stage=False, name=relpath)
+    # Replace the entry if the path is already in the index (dropping
+    # its other stages, if any), otherwise add it.  Positions were found
+    # before we changed anything: appending only adds at the end.
+    if positions:
+      index.entries[positions[0]] = entry
+      drop.extend(positions[1:])
+    else:
       index.entries.append(entry)
-
-    # Write the index back
-    write_index(repo, index)
+    index.invalidate_path(relpath)
+
+  index.remove(drop)
+
+  if not (changed or drop or monitored):
+    return
+
+  # Objects must be in place before the index points to them.
+  repo.object_batch().flush()
+
+  # Write the index back
+  repo.write_index(index)
+
+def add_walk(repo, index, path, ignore, cone):
+  """Yield the names of the files below directory path ("" for the
+  whole worktree) which add considers: those in the index, and those
+  neither ignored nor outside the sparse checkout."""
+  for (root, dirs, files) in os.walk(os.path.join(repo.worktree, path)):
+    rel = os.path.relpath(root, repo.worktree)
+    prefix = "" if rel == "." else rel + "/"
+    # Tracked files in ignored directories are found from the index.
+    dirs[:] = [ d for d in dirs if d != ".git" and not check_ignore(ignore, prefix + d, True) ]
+    # os.walk lists symlinks to directories with them, but doesn't
+    # follow them: they're symlinks to add, like the others.
+    files = files + [ d for d in dirs if os.path.islink(os.path.join(root, d)) ]
+    for f in files:
+      name = prefix + f
+      if index.find(name) is not None:
+        yield name
+      elif not check_ignore(ignore, name) and not (cone and not cone.includes(name)):
+        yield name
 
 argsp = argsubparsers.add_parser("commit", help="Record changes to the repository.")
 
@@ -937,7 +2010,7 @@ def gitconfig_read():
     ]
 
     config = configparser.ConfigParser()
-    config.read(configfiles)
+    conf_read(config, configfiles)
     return config
 
 def gitconfig_user_get(config):
@@ -947,67 +2020,80 @@ def gitconfig_user_get(config):
     return None
 
 def tree_from_index(repo, index):
-    contents = dict()
-    contents[""] = list()
-
-    # Enumerate entries, and turn them into a dictionary where keys
-    # are directories, and values are lists of directory contents.
-    for entry in index.entries:
-        dirname = os.path.dirname(entry.name)
-
-        # We create all dictonary entries up to root ("").  We need
-        # them *all*, because even if a directory holds no files it
-        # will contain at least a tree.
-        key = dirname
-        while key != "":
-            if not key in contents:
-                contents[key] = list()
-            key = os.path.dirname(key)
-
-        # For now, simply store the entry in the list.
-        contents[dirname].append(entry)
-
-    # Get keys (= directories) and sort them by length, descending.
-    # This means that we'll always encounter a given path before its
-    # parent, which is all we need, since for each directory D we'll
-    # need to modify its parent P to add D's tree.
-    sorted_paths = sorted(contents.keys(), key=len, reverse=True)
-
-    # This variable will store the current tree's SHA-1.  After we're
-    # done iterating over our dict, it will contain the hash for the
-    # root tree.
-    sha = None
-
-    # We ge through the sorted list of paths (dict keys)
-    for path in sorted_paths:
-        # Prepare a new, empty tree object
+    """Write the trees for the content of index, return the SHA of the
+    root tree.
+
+    The index remembers the trees of the last commit in its cached
+    tree (see GitCacheTree), and add and rm invalidate the directories
+    they touch.  So we only build and write the trees of those
+    directories: for each other directory, the cached SHA is used
+    directly, and all the entries below it are skipped, whatever their
+    number.  The cached tree is updated along the way; the caller
+    writes the index back to save it."""
+    if index.cache_tree is None:
+        index.cache_tree = GitCacheTree()
+
+    # Entries must come in path order, so that the entries of each
+    # directory are contiguous.
+    names = index.names
+    order = index.order()
+
+    # Parents need the SHA of their subtrees, so trees are serialized
+    # and hashed in order, but compressing and writing them doesn't
+    # have to wait: that's done by a pool of threads.
+    writer = object_writer_open(repo)
+
+    def tree_build(pos, prefix, node):
+        """Build the tree for directory prefix ("" or ending with a /),
+        whose entries start at order[pos].  Return the position
+        following its last entry."""
+        if node.valid():
+            return pos + node.entry_count
+
+        start = pos
         tree = GitTree()
+        seen = set()
+        while pos < len(order) and names[order[pos]].startswith(prefix):
+            i = order[pos]
+            rest = names[i][len(prefix):]
+            if index.mode[i] == INDEX_SPARSE_DIR_MODE and not "/" in rest[:-1]:
+                # A sparse directory entry for a subdirectory of prefix:
+                # the whole tree, outside the sparse checkout.  Deeper
+                # ones are found by recursing, like files.
+                tree.items.append(GitTreeLeaf(mode=b"040000", path=rest[:-1], binsha=bytes(index.shas[20*i:20*i+20])))
+                pos += 1
+            elif "/" in rest:
+                # Tree: build it first, with all the entries below.
+                base = rest.split("/", 1)[0]
+                sub = node.subtrees.get(base)
+                if sub is None:
+                    sub = node.subtrees[base] = GitCacheTree()
+                seen.add(base)
+                pos = tree_build(pos, prefix + base + "/", sub)
+                tree.items.append(GitTreeLeaf(mode=b"040000", path=base, binsha=sub.binsha))
+            else:
+                # Regular entry (a file).  We transcode the mode: the
+                # index stores it as an integer, we need an octal ASCII
+                # representation for the tree.
+                leaf_mode = "{:06o}".format(index.mode[i]).encode("ascii")
+                tree.items.append(GitTreeLeaf(mode=leaf_mode, path=rest, binsha=bytes(index.shas[20*i:20*i+20])))
+                pos += 1
 
-        # Add each entry to our new tree, in turn
-        for entry in contents[path]:
-            # An entry can be a normal GitIndexEntry read from the
-            # index, or a tree we've created.
-            if isinstance(entry, GitIndexEntry): # Regular entry (a file)
-
-                # We transcode the mode: the entry stores it as integers,
-                # we need an octal ASCII representation for the tree.
-                leaf_mode = "{:02o}{:04o}".format(entry.mode_type, entry.mode_perms).encode("ascii")
-                leaf = GitTreeLeaf(mode = leaf_mode, path=os.path.basename(entry.name), sha=entry.sha)
-            else: # Tree.  We've stored it as a pair: (basename, SHA)
-                leaf = GitTreeLeaf(mode = b"040000", path=entry[0], sha=entry[1])
-
-            tree.items.append(leaf)
+        # Subtrees that don't exist anymore.
+        for base in set(node.subtrees) - seen:
+            del node.subtrees[base]
 
         # Write the new tree object to the store.
-        sha = object_write(tree, repo)
+        node.binsha = bytes.fromhex(object_write(tree, repo, writer))
+        node.entry_count = pos - start
+        return pos
 
-        # Add the new tree hash to the current dictionary's parent, as
-        # a pair (basename, SHA)
-        parent = os.path.dirname(path)
-        base = os.path.basename(path) # The name without the path, eg main.go for src/main.go
-        contents[parent].append((base, sha))
+    tree_build(0, "", index.cache_tree)
 
-    return sha
+    # Every tree must be in the store before anyone points to the root.
+    writer.close()
+
+    return index.cache_tree.binsha.hex()
 
 def commit_create(repo, tree, parent, author, timestamp, message):
     commit = GitCommit() # Create the new commit object.
@@ -1032,7 +2118,8 @@ def commit_create(repo, tree, parent, author, timestamp, message):
 def cmd_commit(args):
     repo = find_git_repo()
     index = repo.read_index()
-    # Create trees, grab back SHA for the root tree.
+    # Create trees, grab back SHA for the root tree.  Only the
+    # directories changed since the last commit are written.
     tree = tree_from_index(repo, index)
 
     # Create the commit object itself
@@ -1043,11 +2130,190 @@ def cmd_commit(args):
                            datetime.now(),
                            args.message)
 
+    # The trees and the commit must be durable before a ref points to
+    # them.  In batch mode, this is the only time we wait for the disk.
+    repo.object_batch().flush()
+
+    # Save the updated cached tree, for the next commit.
+    repo.write_index(index)
+
     # Update HEAD so our commit is now the tip of the active branch.
     active_branch = branch_get_active(repo)
     if active_branch: # If we're on a branch, we update refs/heads/BRANCH
-        with open(repo.create_filerepo(os.path.join("refs/heads", active_branch)), "w") as fd:
-            fd.write(commit + "\n")
+        repo.write_atomic(os.path.join("refs/heads", active_branch), (commit + "\n").encode("ascii"))
     else: # Otherwise, we update HEAD itself.
-        with open(repo.create_filerepo("HEAD"), "w") as fd:
-            fd.write("\n")
+        repo.write_atomic("HEAD", (commit + "\n").encode("ascii"))
+
+argsp = argsubparsers.add_parser("repack", help="Pack reachable objects into a single packfile.")
+
+argsp.add_argument("-d",
+                   dest="delete",
+                   action="store_true",
+                   help="Delete the previous packs once the new one is written.")
+
+argsp.add_argument("--window",
+                   type=int,
+                   default=10,
+                   help="Number of objects each object is tried against for deltas.")
+
+argsp.add_argument("--depth",
+                   type=int,
+                   default=50,
+                   help="Maximum length of a delta chain.")
+
+argsp.add_argument("-j", "--jobs",
+                   type=int,
+                   default=None,
+                   help="Number of processes computing deltas (default: pack.threads, or one per CPU).")
+
+def cmd_repack(args):
+    repo = find_git_repo()
+    repack(repo, delete=args.delete, window=args.window, depth=args.depth, jobs=args.jobs)
+
+argsp = argsubparsers.add_parser("gc", help="Cleanup and pack the repository (same as repack -d).")
+
+def cmd_gc(args):
+    repo = find_git_repo()
+    repack(repo, delete=True)
+
+# The order in which object types are laid out in our packs: same as
+# git, commits first, then tags, trees and blobs.
+PACK_TYPE_ORDER = { b'commit': 0, b'tag': 1, b'tree': 2, b'blob': 3 }
+
+# Objects are handed to worker processes by segments of about this
+# many objects.  Deltas are only searched within a segment.
+PACK_SEGMENT_SIZE = 1024
+
+def ref_list_shas(refs, ret=None):
+    """Flatten the output of ref_list to a list of SHAs."""
+    if ret is None:
+        ret = list()
+    for v in refs.values():
+        if type(v) == str:
+            ret.append(v)
+        elif v:
+            ref_list_shas(v, ret)
+    return ret
+
+def object_walk(repo, shas):
+    """Enumerate every object reachable from shas.  Return a list of
+    (sha, fmt, data, path), where path is the path at which we first
+    met a tree or a blob, and "" for commits and tags."""
+    ret = list()
+    seen = set()
+    stack = [ (sha, "") for sha in shas ]
+
+    while stack:
+        sha, path = stack.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+
+        raw = object_read_raw(repo, sha)
+        if raw is None:
+            raise Exception("Missing object {0}".format(sha))
+        fmt, data = raw
+        ret.append((sha, fmt, data, path))
+
+        match fmt:
+            case b'commit':
+                commit = GitCommit(data)
+                stack.append((commit.kvlm[b'tree'].decode("ascii"), ""))
+                parents = commit.kvlm.get(b'parent', [])
+                if type(parents) != list:
+                    parents = [ parents ]
+                for p in parents:
+                    stack.append((p.decode("ascii"), ""))
+            case b'tag':
+                stack.append((GitTag(data).kvlm[b'object'].decode("ascii"), ""))
+            case b'tree':
+                for leaf in GitTree(data).tree_iter():
+                    # Submodules point to commits in another repository.
+                    if leaf.mode.startswith(b'16'):
+                        continue
+                    stack.append((leaf.sha, os.path.join(path, leaf.path)))
+
+    return ret
+
+def repack(repo, delete=False, window=10, depth=50, jobs=None):
+    """Write every object reachable from a ref (or HEAD) to a new pack,
+    then prune the loose objects it holds.  With delete, the previous
+    packs are removed too: objects they held that aren't reachable
+    anymore are lost, like with git repack -a -d."""
+    tips = ref_list_shas(ref_list(repo))
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        tips.append(head)
+
+    objects = object_walk(repo, tips)
+    if not objects:
+        print("Nothing to pack.")
+        return
+
+    # Sort so that objects likely to delta against each other are
+    # neighbours: by type, then file name (the same file across
+    # history, or same-named files across directories), then path, then
+    # size, larger first, so that deltas mostly remove data.
+    objects.sort(key=lambda o: (PACK_TYPE_ORDER[o[1]], os.path.basename(o[3]), o[3], -len(o[2])))
+
+    # Split in segments, only on type or path changes so that the
+    # history of a given file stays in a single segment.
+    segments = list()
+    segment = list()
+    prev = None
+    for (sha, fmt, data, path) in objects:
+        if segment and (prev[0] != fmt or (len(segment) >= PACK_SEGMENT_SIZE and prev[1] != path)):
+            segments.append(segment)
+            segment = list()
+        segment.append((sha, PACK_FMT_TYPE[fmt], data))
+        prev = (fmt, path)
+    segments.append(segment)
+
+    if jobs is None:
+        jobs = int(repo.conf.get("pack", "threads", fallback=0)) or os.cpu_count() or 1
+
+    big_file_threshold = repo.conf_get_size("core", "bigFileThreshold", 512 * 1024**2)
+
+    n = len(segments)
+    if jobs > 1 and n > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, n)) as pool:
+            # map() returns results in order, so the pack doesn't
+            # depend on which worker finishes first.
+            results = list(pool.map(pack_compress_segment, segments,
+                                    [window] * n, [depth] * n, [big_file_threshold] * n))
+    else:
+        results = [ pack_compress_segment(segment, window, depth, big_file_threshold)
+                    for segment in segments ]
+
+    entries = [ e for result in results for e in result ]
+    deltas = sum(1 for e in entries if e[2] is not None)
+
+    old_packs = [ pack.pack_path for pack in repo.pack_list() ]
+    pack_dir = os.path.join(repo.gitdir, "objects", "pack")
+    pack_path, shas = pack_write(pack_dir, entries, len(entries))
+
+    if delete:
+        for old in old_packs:
+            if old == pack_path:
+                continue
+            for ext in (".pack", ".idx"):
+                os.unlink(old[:-5] + ext)
+
+    # Prune loose objects that are now packed.
+    pruned = 0
+    for sha in shas:
+        path = os.path.join(repo.gitdir, "objects", sha[0:2], sha[2:])
+        if os.path.isfile(path):
+            os.unlink(path)
+            pruned += 1
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass # Not empty yet.
+
+    # The set of packs and loose objects changed under our feet.
+    repo.packs = None
+    repo.loose = None
+
+    print("Packed {0} objects ({1} deltas) into {2}, pruned {3} loose objects.".format(
+        len(entries), deltas, os.path.basename(pack_path), pruned))